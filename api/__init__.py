@@ -2,12 +2,31 @@ from flask_api import FlaskAPI
 from flask_login import LoginManager
 from flask_jwt_extended import JWTManager
 from api.models import RevokedTokens, db
+from api.cache import FragmentCache, ResponseCache, RevocationCache
+from api.auth import IdentityCache
+from api.encoders import ResponseEncoder
+from api.passwords import PasswordHasher
+from api.ratelimit import RateLimiter
+from api.jobs import JobQueue
+from api.instrumentation import QueryInstrumentation
+from api.metrics import Metrics
 from flask_cors import CORS
+from werkzeug.contrib.fixers import ProxyFix
 
 from config import config_app
 
 login_manager = LoginManager()
 jwt = JWTManager()
+revocation_cache = RevocationCache()
+identity_cache = IdentityCache()
+response_cache = ResponseCache()
+fragment_cache = FragmentCache()
+response_encoder = ResponseEncoder()
+password_hasher = PasswordHasher()
+rate_limiter = RateLimiter()
+job_queue = JobQueue()
+query_instrumentation = QueryInstrumentation()
+metrics = Metrics()
 
 
 def create_app(config_name):
@@ -16,6 +35,8 @@ def create_app(config_name):
     app.config.from_object(config_app[config_name])
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.url_map.strict_slashes = False
+    if app.config.get('TRUSTED_PROXIES'):
+        app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=app.config['TRUSTED_PROXIES'])
 
     from .admin import admin as admin_blueprint
     app.register_blueprint(admin_blueprint)
@@ -30,12 +51,21 @@ def create_app(config_name):
     app.register_blueprint(errors_blueprint)
 
     app.config['SECRET_KEY'] = '\xe3\x8cw\xbdx\x0f\x9c\x91\xcf\x91\x81\xbdZ\xdc$\xedk!\xce\x19\xaa\xcb\xb7~'
-    app.config['BCRYPT_LOG_ROUNDS'] = 15
     app.config['JWT_SECRET_KEY'] = '\xe3\x8cw\xbdx\x0f\x9c\x91\xcf\x91\x81\xbdZ\xdc$\xedk!\xce\x19\xaa\xcb\xb7~'
     app.config['JWT_BLACKLIST_ENABLED'] = True
     app.config['JWT_BLACKLIST_TOKEN_CHECKS'] = ['access']
+    response_encoder.init_app(app)
     db.init_app(app)
+    query_instrumentation.init_app(app)
+    metrics.init_app(app)
     jwt.init_app(app)
+    revocation_cache.init_app(app)
+    identity_cache.init_app(app)
+    password_hasher.init_app(app)
+    rate_limiter.init_app(app)
+    job_queue.init_app(app)
+    response_cache.init_app(app)
+    fragment_cache.init_app(app)
     login_manager.init_app(app)
     login_manager.login_message = "Login is required to access this feature."
 
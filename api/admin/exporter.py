@@ -0,0 +1,84 @@
+"""
+Streaming export of the catalogue and the borrowing history as CSV or JSON lines.
+"""
+import csv
+from io import StringIO
+
+from api.encoders import dumps
+from api.models import Book, BorrowingHistory, db
+
+FORMATS = ('csv', 'jsonl')
+
+MEDIA_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson'
+}
+
+# Rows fetched from the server-side cursor, and written, per chunk
+EXPORT_BATCH_SIZE = 1000
+
+# Columns of the books export, named like the import file's columns
+BOOK_COLUMNS = ('book_id', 'title', 'author', 'description', 'availability', 'created_at', 'deleted')
+
+HISTORY_COLUMNS = ('id', 'book_id', 'book_title', 'book_author', 'user_id', 'date_borrowed', 'due_date',
+                   'returned', 'returned_date')
+
+EXPORTS = {
+    'books': (Book, BOOK_COLUMNS),
+    'history': (BorrowingHistory, HISTORY_COLUMNS)
+}
+
+
+def _rows(model, columns, batch_size):
+    """
+    Iterate the rows of a table as plain tuples through a server-side cursor.
+    yield_per keeps only one batch of rows in memory and skips building ORM objects.
+    :param model:
+    :param columns:
+    :param batch_size:
+    :return:
+    """
+    mapped = [getattr(model, column) for column in columns]
+    return db.session.query(*mapped).order_by(mapped[0]).yield_per(batch_size)
+
+
+def _chunks(rows, batch_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= batch_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_rows(name, fmt='jsonl', batch_size=EXPORT_BATCH_SIZE):
+    """
+    Generate an export as encoded chunks, one batch of rows at a time
+    :param name: books or history
+    :param fmt: csv or jsonl
+    :param batch_size:
+    :return:
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Format must be one of: {}'.format(', '.join(FORMATS)))
+    model, columns = EXPORTS[name]
+    rows = _rows(model, columns, batch_size)
+
+    if fmt == 'jsonl':
+        for chunk in _chunks(rows, batch_size):
+            yield b''.join(dumps(dict(zip(columns, row))) + b'\n' for row in chunk)
+        return
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in _chunks(rows, batch_size):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # Only the header is left when the table is empty
+        yield buffer.getvalue().encode('utf-8')
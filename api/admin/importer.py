@@ -0,0 +1,186 @@
+"""
+Bulk import of books from CSV or JSON lines files.
+"""
+import codecs
+import csv
+import json
+from datetime import date
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+
+from api.models import Book, CatalogueVersion, db
+
+# Column lengths of the books table
+MAX_TITLE_LENGTH = 60
+MAX_AUTHOR_LENGTH = 60
+
+FORMATS = ('csv', 'jsonl')
+
+
+def validate_book(title, description, author):
+    """
+    Validate book fields the way the add book endpoint does
+    :param title:
+    :param description:
+    :param author:
+    :return: an error message, or None when the book is valid
+    """
+    if not title or title.isspace():
+        return 'Book must have a Title'
+
+    if not description or description.isspace():
+        return 'Book must have a Description'
+
+    if not author or author.isspace():
+        return 'Book must have an Author'
+
+    return None
+
+
+def guess_format(filename):
+    """
+    Guess the import format from a file name
+    :param filename:
+    :return:
+    """
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+
+def _parse_availability(value):
+    if value is None or value == '':
+        return True
+    if isinstance(value, str):
+        return value.strip().lower() not in ('false', '0', 'no', 'n')
+    return bool(value)
+
+
+def read_rows(stream, fmt):
+    """
+    Lazily read rows from a binary stream.
+    Yields (row_number, row) pairs; row is an error message for lines that
+    cannot be parsed.
+    :param stream:
+    :param fmt:
+    :return:
+    """
+    text = codecs.iterdecode(stream, 'utf-8')
+    if fmt == 'csv':
+        for row_number, row in enumerate(csv.DictReader(text), 1):
+            yield row_number, row
+        return
+
+    for row_number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield row_number, 'Invalid JSON'
+            continue
+        if not isinstance(row, dict):
+            row = 'Each line must be a JSON object'
+        yield row_number, row
+
+
+def _insert_batch(batch):
+    """
+    Insert one batch of validated rows in a single transaction.
+    Titles that already exist are reported instead of inserted.
+    :param batch:
+    :return: the number of books inserted and the rows rejected
+    """
+    # An expanding parameter keeps the IN list from being compiled value by value
+    existing = {title for title, in db.session.query(Book.title)
+                .filter(Book.title.in_(bindparam('titles', expanding=True)))
+                .params(titles=[values['title'] for _, values in batch])}
+
+    rows = []
+    errors = []
+    for row_number, values in batch:
+        if values['title'] in existing:
+            errors.append({'row': row_number, 'message': 'Book with that title already exists.'})
+        else:
+            rows.append(values)
+
+    # One compiled INSERT sent with executemany, the driver batches the rows
+    if rows:
+        db.session.execute(Book.__table__.insert(), rows)
+        CatalogueVersion.bump()
+    db.session.commit()
+    return len(rows), errors
+
+
+def import_books(stream, fmt='csv', batch_size=500):
+    """
+    Import books from a binary stream of CSV or JSON lines.
+    Rows are validated one by one and inserted in batches of batch_size,
+    each batch in its own transaction.
+    :param stream:
+    :param fmt:
+    :param batch_size:
+    :return: a summary with the number of imported books and per-row errors
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Format must be one of: {}'.format(', '.join(FORMATS)))
+
+    imported = 0
+    errors = []
+    seen = set()
+    batch = []
+    today = date.today()
+
+    def flush():
+        try:
+            inserted, rejected = _insert_batch(batch)
+        except IntegrityError:
+            # A concurrent insert took one of the titles, re-check and retry once
+            db.session.rollback()
+            inserted, rejected = _insert_batch(batch)
+        errors.extend(rejected)
+        return inserted
+
+    for row_number, row in read_rows(stream, fmt):
+        if isinstance(row, str):
+            errors.append({'row': row_number, 'message': row})
+            continue
+
+        title = row.get('title')
+        description = row.get('description')
+        author = row.get('author')
+        if not all(value is None or isinstance(value, str) for value in (title, description, author)):
+            errors.append({'row': row_number, 'message': 'Title, Description and Author must be text'})
+            continue
+
+        message = validate_book(title, description, author)
+        if message is None and len(title) > MAX_TITLE_LENGTH:
+            message = 'Title must be at most {} characters'.format(MAX_TITLE_LENGTH)
+        if message is None and len(author) > MAX_AUTHOR_LENGTH:
+            message = 'Author must be at most {} characters'.format(MAX_AUTHOR_LENGTH)
+        if message is None and title in seen:
+            message = 'Duplicate title in file'
+        if message:
+            errors.append({'row': row_number, 'message': message})
+            continue
+
+        seen.add(title)
+        batch.append((row_number, {
+            'title': title,
+            'description': description,
+            'author': author,
+            'availability': _parse_availability(row.get('availability')),
+            'created_at': today,
+            'deleted': False
+        }))
+
+        if len(batch) >= batch_size:
+            imported += flush()
+            batch = []
+
+    if batch:
+        imported += flush()
+
+    errors.sort(key=lambda error: error['row'])
+    return {'imported': imported, 'errors': errors}
@@ -1,11 +1,16 @@
-from flask import jsonify, request
+from flask import Response, request, stream_with_context
 from jsonschema import validate
+from sqlalchemy.exc import IntegrityError
 from flask_jwt_extended import get_raw_jwt, get_jwt_identity, jwt_required
 
-from api.models import User, Book, RevokedTokens
+from api.models import User, Book, BorrowingHistory, CatalogueVersion, RevokedTokens, date, pool_stats
 from . import admin
+from .exporter import EXPORTS, MEDIA_TYPES, export_rows
+from .importer import FORMATS, guess_format, import_books, validate_book
 from api.models import db
-from api.decorators import admin_user
+from api.cache import ResponseCache
+from api.encoders import jsonify
+from api.decorators import admin_user, allow_pagination
 
 
 # def verify_token_and_if_user_is_admin():
@@ -33,19 +38,10 @@ def create_book():
     author = request.data.get('author')
     availability = request.data.get('availability')
 
-    if not title or title.isspace():
+    message = validate_book(title, description, author)
+    if message:
         return jsonify({
-            'message': 'Book must have a Title'
-        }), 400
-
-    if not description or description.isspace():
-        return jsonify({
-            'message': 'Book must have a Description'
-        }), 400
-
-    if not author or author.isspace():
-        return jsonify({
-            'message': 'Book must have an Author'
+            'message': message
         }), 400
 
     # if availability is None:
@@ -53,21 +49,72 @@ def create_book():
     #         'message': 'Book must have an availability status'
     #     }), 400
 
-    books = Book.all_books()
+    if Book.title_taken(title):
+        return {'message': 'Book with that title already exists.'}, 400
 
-    present = [book for book in books if book.title == title]
-    if present:
+    new_book = Book(title=title,
+                    description=description,
+                    availability=availability,
+                    author=author)
+    try:
+        new_book.create_book()
+    except IntegrityError:
+        db.session.rollback()
         return {'message': 'Book with that title already exists.'}, 400
 
+    return jsonify({'message': 'Book added successfully.'}), 201
+
+
+@admin.route('/api/v2/books/import', methods=['POST'])
+@jwt_required
+@admin_user
+def bulk_import_books():
+    """
+    Function to add books in bulk from a CSV or JSON lines file.
+    The file is sent as the multipart field "file" or as the raw request body.
+    :return:
+    """
+    content_type = request.content_type or ''
+    upload = request.files.get('file') if content_type.startswith('multipart/form-data') else None
+    if upload is not None:
+        stream = upload.stream
+        fmt = request.args.get('format') or guess_format(upload.filename)
     else:
+        stream = request.stream
+        fmt = request.args.get('format') or ('jsonl' if 'json' in content_type else 'csv')
 
-        new_book = Book(title=title,
-                        description=description,
-                        availability=availability,
-                        author=author)
-        new_book.create_book()
+    if fmt not in FORMATS:
+        return {'message': 'Format must be one of: {}'.format(', '.join(FORMATS))}, 400
 
-    return jsonify({'message': 'Book added successfully.'}), 201
+    try:
+        summary = import_books(stream, fmt)
+    except UnicodeDecodeError:
+        return {'message': 'The file must be UTF-8 encoded'}, 400
+
+    return jsonify(summary), 200
+
+
+@admin.route('/api/v2/admin/export/<name>', methods=['GET'])
+@jwt_required
+@admin_user
+def export(name):
+    """
+    Function to download all books or the whole borrowing history.
+    Rows are streamed as CSV or JSON lines (the format argument, jsonl by default)
+    while they are read, so the export is never held in memory.
+    :param name: books or history
+    :return:
+    """
+    if name not in EXPORTS:
+        return {'message': 'Export must be one of: {}'.format(', '.join(sorted(EXPORTS)))}, 404
+
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in FORMATS:
+        return {'message': 'Format must be one of: {}'.format(', '.join(FORMATS))}, 400
+
+    filename = '{}.{}'.format(name, fmt)
+    return Response(stream_with_context(export_rows(name, fmt)), mimetype=MEDIA_TYPES[fmt],
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
 
 
 @admin.route('/api/v2/book/<int:book_id>', methods=['DELETE'])
@@ -82,6 +129,7 @@ def delete_book(book_id):
 
     if data:
         data.deleted = True
+        CatalogueVersion.bump()
         db.session.commit()
         return jsonify({'message': 'Book deleted successfully.'}), 200
     else:
@@ -142,6 +190,42 @@ def edit_put(book_id):
         book_find.description = data["description"]
         book_find.author = data["author"]
         # book_find.availability = data["availability"]
+        CatalogueVersion.bump()
         db.session.commit()
 
     return jsonify({'message': 'Book updated successfully.'}), 200
+
+
+@admin.route('/api/v2/admin/overdue', methods=['GET'])
+@jwt_required
+@admin_user
+@allow_pagination(default_limit=20, cursor=False)
+def overdue_loans():
+    """
+    Function to list open loans past their due date with their fines,
+    longest overdue first and 20 per page unless a limit is given
+    :return:
+    """
+    return BorrowingHistory.overdue_loans(date.today())
+
+
+@admin.route('/api/v2/admin/cache', methods=['GET'])
+@jwt_required
+@admin_user
+def response_cache_stats():
+    """
+    Function to report the response cache counters of this worker
+    :return:
+    """
+    return jsonify(ResponseCache.stats()), 200
+
+
+@admin.route('/api/v2/admin/pool', methods=['GET'])
+@jwt_required
+@admin_user
+def connection_pool_stats():
+    """
+    Function to report the database connection pool of this worker
+    :return:
+    """
+    return jsonify(pool_stats()), 200
@@ -0,0 +1,77 @@
+"""
+Loading of the logged in user.
+"""
+from flask import current_app, g
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+from .cache import LRUCache
+from .models import User, db
+
+
+class IdentityCache(object):
+    """
+    Short lived cache of user rows keyed by email.
+
+    Entries live for CURRENT_USER_CACHE_TTL seconds and are dropped as soon
+    as this worker updates or deletes the user. Setting the TTL to 0 turns
+    the cache off.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CURRENT_USER_CACHE_TTL', 30)
+        app.config.setdefault('CURRENT_USER_CACHE_SIZE', 4096)
+        ttl = app.config['CURRENT_USER_CACHE_TTL']
+        app.extensions['identity_cache'] = LRUCache(app.config['CURRENT_USER_CACHE_SIZE'], ttl) if ttl else None
+
+
+def _cache():
+    return current_app.extensions.get('identity_cache')
+
+
+def _load_user(email):
+    """
+    Load a user by email, from the identity cache when possible
+    :param email:
+    :return:
+    """
+    cache = _cache()
+    values = cache.get(email) if cache is not None else None
+    if values is None:
+        user = User.get_user_by_email(email)
+        if user is not None and cache is not None:
+            cache.set(email, {column.key: getattr(user, column.key) for column in User.__table__.columns})
+        return user
+
+    # Attach a copy of the cached row to this request's session without a query
+    user = User(username=values['username'],
+                user_password=values['user_password'],
+                email=values['email'],
+                is_admin=values['is_admin'])
+    user.id = values['id']
+    user.created_at = values['created_at']
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def get_current_user():
+    """
+    Return the logged in user, loaded at most once per request
+    :return:
+    """
+    if 'current_user' not in g:
+        g.current_user = _load_user(get_jwt_identity())
+    return g.current_user
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _forget_user(mapper, connection, target):
+    cache = _cache()
+    if cache is not None:
+        cache.delete(target.email)
@@ -1,28 +1,66 @@
-from flask import jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from collections import OrderedDict
 
-from api.models import Book, User, BorrowingHistory, datetime, timedelta
+from flask import request
+from flask_jwt_extended import jwt_required
+
+from api.auth import get_current_user
+from api.cache import fragments_response
+from api.encoders import jsonify
+from api.models import Book, BorrowingHistory, ConcurrentLoanError, datetime, timedelta
 from . import book
-from api.decorators import allow_pagination
+from api.decorators import allow_pagination, cached_response, catalogue_etag
+
+# Most books a single bulk borrow or return may contain
+MAX_BULK_BOOKS = 100
+
+BULK_BORROW_MESSAGES = {
+    'borrowed': (200, "Book borrowed Successfully."),
+    'not_available': (403, "This Book is not available for borrowing."),
+    'not_found': (403, "Book does not exist")
+}
+
+BULK_RETURN_MESSAGES = {
+    'returned': (200, "Book returned successfully."),
+    'not_borrowed': (403, "This book is not borrowed."),
+    'not_found': (403, "Book does not exist.")
+}
 
 
 @book.route('/api/v2/books', methods=['GET'])
+@catalogue_etag
+@cached_response
 @allow_pagination
 def get_all_books():
     """
     Function to return all books.
+    Paging and serialization happen in allow_pagination.
     :return:
     """
     all_books = Book.get_all_books()
 
-    if not all_books:
+    if all_books.first() is None:
         return jsonify({"Message": "Library is empty."}), 204
-    else:
-        response = [book.serialize for book in all_books]
-        return jsonify(response), 200
+    return all_books
+
+
+@book.route('/api/v2/books/search', methods=['GET'])
+@catalogue_etag
+@allow_pagination(default_limit=20, cursor=False)
+def search_books():
+    """
+    Function to search books by title, author and description.
+    Results are ranked and paginated, 20 per page unless a limit is given.
+    :return:
+    """
+    terms = request.args.get('q', '')
+    if not terms.strip():
+        return {'message': 'Provide search terms with the q parameter.'}, 400
+    return Book.search(terms)
 
 
 @book.route('/api/v2/book/<int:book_id>', methods=['GET'])
+@catalogue_etag
+@cached_response
 def get_book_by_id(book_id):
     """
     Function to find a single book
@@ -33,11 +71,7 @@ def get_book_by_id(book_id):
 
     if not data:
         return {'Error': 'Book Does not Exist'}, 404
-    else:
-        response = jsonify(data.serialize)
-        response.status_code = 200
-
-    return response
+    return fragments_response(data)
 
 
 @book.route('/api/v2/users/book/<int:book_id>', methods=['POST'])
@@ -48,35 +82,15 @@ def borrow_book(book_id):
     :param book_id:
     :return:
     """
-    book_is_present = Book.get_book(book_id)
-    if not book_is_present:
-        return {"Error": "Book does not exist"}, 403
-
-    available_books = Book.get_book_available_for_borrowing()
-    book_is_available = [book for book in available_books if book.book_id == book_id]
-    if not book_is_available:
-        return {"Error": "This Book is not available for borrowing."}, 403
-
-    else:
-        logged_user_email = get_jwt_identity()
-        logged_user = User.get_user_by_email(logged_user_email)
-        user_id = logged_user.id
-        due_date = datetime.now() + timedelta(days=6)
-        date_borrowed = datetime.now()
-        BorrowingHistory(user_id=user_id,
-                         book_id=book_id,
-                         due_date=due_date,
-                         date_borrowed=date_borrowed,
-                         book_title=book_is_present.title,
-                         book_author=book_is_present.author,
-                         book_description=book_is_present.description).borrow_book()
-
-        book = Book.get_book(book_id)
-        book.availability = False
-        book.create_book()
+    due_date = datetime.now() + timedelta(days=6)
 
+    if BorrowingHistory.borrow(book_id, get_current_user().id, due_date):
         return {"Success": "Book borrowed Successfully."}, 200
 
+    if not Book.get_book(book_id):
+        return {"Error": "Book does not exist"}, 403
+    return {"Error": "This Book is not available for borrowing."}, 403
+
 
 @book.route('/api/v2/users/book/<int:book_id>', methods=['PUT'])
 @jwt_required
@@ -86,46 +100,93 @@ def return_book(book_id):
     :param book_id:
     :return:
     """
-    book = Book.get_book(book_id)
+    if BorrowingHistory.return_borrowed(book_id):
+        return {"message": "Book returned successfully."}, 200
 
-    if book is None:
+    if Book.get_book(book_id) is None:
         return {"message": "Book does not exist."}, 403
+    return {"message": "This book is not borrowed."}, 403
 
-    if book.availability is True:
-        return {"message": "This book is not borrowed."}, 403
 
-    book.availability = True
-    book.create_book()
+def _bulk_book_ids():
+    """
+    Read the list of book ids sent to a bulk endpoint
+    :return: the ids without duplicates, or None when the input is invalid
+    """
+    book_ids = request.data.get('book_ids') if hasattr(request.data, 'get') else None
+    if not isinstance(book_ids, list) or not book_ids or len(book_ids) > MAX_BULK_BOOKS:
+        return None
+    if not all(isinstance(book_id, int) and not isinstance(book_id, bool) for book_id in book_ids):
+        return None
+    return list(OrderedDict.fromkeys(book_ids))
 
-    update = BorrowingHistory.get_book(book_id)
-    update.returned = True
-    update.returned_date = datetime.now()
-    update.borrow_book()
 
-    return {"message": "Book returned successfully."}, 200
+def _bulk_loans(action, messages, *args):
+    """
+    Run a bulk borrow or return and describe the outcome for every book
+    :param action:
+    :param messages:
+    :param args:
+    :return:
+    """
+    book_ids = _bulk_book_ids()
+    if book_ids is None:
+        return {"message": "book_ids must be a list of at most {} book ids.".format(MAX_BULK_BOOKS)}, 400
+
+    try:
+        outcome = action(book_ids, *args)
+    except ConcurrentLoanError:
+        # Someone else borrowed or returned one of the books meanwhile, try once more
+        try:
+            outcome = action(book_ids, *args)
+        except ConcurrentLoanError:
+            return {"message": "The books changed while being processed, please try again."}, 409
+
+    results = []
+    for book_id in book_ids:
+        status, message = messages[outcome[book_id]]
+        results.append({"book_id": book_id, "status": status, "message": message})
+    return jsonify({"results": results}), 200
+
+
+@book.route('/api/v2/users/books', methods=['POST'])
+@jwt_required
+def borrow_books():
+    """
+    Function to borrow several books at once
+    :return:
+    """
+    due_date = datetime.now() + timedelta(days=6)
+    return _bulk_loans(BorrowingHistory.borrow_many, BULK_BORROW_MESSAGES, get_current_user().id, due_date)
 
 
+@book.route('/api/v2/users/books', methods=['PUT'])
+@jwt_required
+def return_books():
+    """
+    Function to return several books at once
+    :return:
+    """
+    return _bulk_loans(BorrowingHistory.return_many, BULK_RETURN_MESSAGES)
+
 
 @book.route('/api/v2/users/books', methods=['GET'])
 @jwt_required
+@allow_pagination
 def user_borrowing_history():
-    unreturned = BorrowingHistory.unreturned_books_by_user()
-    logged_user_email = get_jwt_identity()
-    logged_user = User.get_user_by_email(logged_user_email)
+    """
+    Function to return the logged in user's borrowing history.
+    Paging and serialization happen in allow_pagination.
+    :return:
+    """
+    logged_user = get_current_user()
     returned = request.args.get('returned')
 
     # get un-returned books
     if returned == 'false':
-        if not unreturned:
+        unreturned = BorrowingHistory.unreturned_books_by_user(logged_user.id)
+        if unreturned.first() is None:
             return jsonify({'Message': 'User does not have unreturned Books'}), 200
-        else:
-            return jsonify([book.serialize for book in unreturned if book.user_id == logged_user.id]), 200
-
-    else:
-        history = BorrowingHistory.user_borrowing_history()
-
-        if history is None:
-            return {"Message": "User doesn't have any borrowing history."}, 204
-
+        return unreturned
 
-        return jsonify([book.serialize for book in history if book.user_id == logged_user.id]), 200
+    return BorrowingHistory.user_borrowing_history(logged_user.id)
@@ -0,0 +1,500 @@
+"""
+In-process caches shared by the api.
+"""
+import hashlib
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from math import ceil, log
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+from .encoders import dumps
+from .models import Book, RevokedTokens, db
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    Bounded least-recently-used mapping with an optional time to live.
+    With maxbytes the values' total weight, len() unless a weigh function
+    is given, is bounded too and values heavier than maxbytes are not kept.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None, weigh=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.weigh = weigh
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under key, or default when missing or expired
+        :param key:
+        :param default:
+        :return:
+        """
+        with self._lock:
+            try:
+                expires, value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Store value under key, evicting the least recently used entry when full
+        :param key:
+        :param value:
+        :return:
+        """
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        weight = self.weigh(value) if self.maxbytes else 0
+        with self._lock:
+            self._pop(key)
+            if self.maxbytes and weight > self.maxbytes:
+                return
+            self._data[key] = (expires, value, weight)
+            self.bytes += weight
+            while len(self._data) > self.maxsize or (self.maxbytes and self.bytes > self.maxbytes):
+                self.bytes -= self._data.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+def private_directory(path):
+    """
+    Create a directory only this user may use, or check an existing one is.
+    Files other users could plant there are never read.
+    :param path:
+    :return:
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    mode = os.lstat(path)
+    if not stat.S_ISDIR(mode.st_mode) or mode.st_uid != os.getuid() or mode.st_mode & 0o077:
+        raise RuntimeError('{} must be a directory owned by this user with mode 0700'.format(path))
+    return path
+
+
+class FileCache(object):
+    """
+    Cache of responses stored as one file per key in a directory, so
+    every worker process on the host shares it. Values are (status,
+    mimetype, body) tuples, written as a 'status mimetype' line followed
+    by the body. The directory must be private to this user. With maxsize
+    the oldest files are removed once the directory holds more entries.
+    """
+
+    def __init__(self, directory, ttl=None, maxsize=None):
+        self.directory = private_directory(directory)
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under key, or default when missing or expired
+        :param key:
+        :param default:
+        :return:
+        """
+        path = self._path(key)
+        try:
+            if self.ttl and os.path.getmtime(path) + self.ttl < time.time():
+                raise FileNotFoundError(path)
+            with open(path, 'rb') as f:
+                head, body = f.read().split(b'\n', 1)
+            status, mimetype = head.decode('ascii').split(' ', 1)
+            value = (int(status), mimetype, body)
+        except (OSError, ValueError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Store value under key. The file is written aside and renamed into
+        place so readers never see a partial entry. Storing is best effort,
+        a full or unwritable disk leaves the entry uncached.
+        :param key:
+        :param value:
+        :return:
+        """
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+            status, mimetype, body = value
+            with os.fdopen(fd, 'wb') as f:
+                f.write('{} {}\n'.format(status, mimetype).encode('ascii'))
+                f.write(body)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            logger.warning('Could not write cache entry to %s', self.directory, exc_info=True)
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return
+        if self.maxsize:
+            self._evict()
+
+    def _entries(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if not name.startswith('.tmp')]
+
+    def _evict(self):
+        """
+        Remove the least recently written entries beyond maxsize
+        :return:
+        """
+        entries = self._entries()
+        if len(entries) <= self.maxsize:
+            return
+        ages = []
+        for path in entries:
+            try:
+                ages.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                pass
+        ages.sort()
+        for _, path in ages[:len(ages) - self.maxsize]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        # Temporary files belong to writes in progress in other workers
+        for path in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self._entries())
+
+
+class BloomFilter(object):
+    """
+    Fixed size Bloom filter for strings.
+    Membership tests may give false positives but never false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class _RevocationState(object):
+    """
+    Revoked token ids known to one worker for one app.
+    """
+
+    def __init__(self, config):
+        self.capacity = config['REVOCATION_CACHE_CAPACITY']
+        self.error_rate = config['REVOCATION_CACHE_ERROR_RATE']
+        self.refresh_interval = config['REVOCATION_CACHE_REFRESH']
+        self.recent = LRUCache(config['REVOCATION_CACHE_RECENT'])
+        self.bloom = None
+        self.built_at = None
+        self.refreshed_at = None
+        self.last_refresh = 0
+        self.lock = threading.Lock()
+
+    def refresh(self, lifetime):
+        """
+        Pull revocations recorded since the last refresh. The Bloom filter is
+        rebuilt once per token lifetime so expired revocations fall out of it.
+        :param lifetime:
+        :return:
+        """
+        now = datetime.now()
+        # Revocations committed by slow transactions may carry an older
+        # timestamp, so every refresh re-reads a short overlap window.
+        overlap = timedelta(seconds=self.refresh_interval * 2 + 1)
+
+        query = RevokedTokens.query.with_entities(RevokedTokens.jti)
+        if self.bloom is None or (lifetime and now - self.built_at > lifetime):
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            if lifetime:
+                query = query.filter(RevokedTokens.time_revoked > now - lifetime - overlap)
+            for jti, in query:
+                bloom.add(jti)
+            self.bloom = bloom
+            self.built_at = now
+        else:
+            for jti, in query.filter(RevokedTokens.time_revoked >= self.refreshed_at - overlap):
+                self.bloom.add(jti)
+                self.recent.set(jti, True)
+        self.refreshed_at = now
+        self.last_refresh = time.monotonic()
+
+
+class RevocationCache(object):
+    """
+    Per-worker cache of revoked JWT ids.
+
+    Lookups for tokens that were never revoked are answered from a Bloom
+    filter without touching the database. The filter is refreshed from
+    revoked_tokens.time_revoked at most every REVOCATION_CACHE_REFRESH
+    seconds, which bounds how long another worker's revocation takes to
+    become visible here. Its queries always read from the primary.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('REVOCATION_CACHE_REFRESH', 5)
+        app.config.setdefault('REVOCATION_CACHE_CAPACITY', 100000)
+        app.config.setdefault('REVOCATION_CACHE_ERROR_RATE', 0.001)
+        app.config.setdefault('REVOCATION_CACHE_RECENT', 1024)
+        app.extensions['revocation_cache'] = _RevocationState(app.config)
+
+    @staticmethod
+    def _state():
+        state = current_app.extensions['revocation_cache']
+        if time.monotonic() - state.last_refresh >= state.refresh_interval:
+            with state.lock:
+                if time.monotonic() - state.last_refresh >= state.refresh_interval:
+                    # A lagging replica would hide revocations from the refresh window for good
+                    with db.primary():
+                        state.refresh(current_app.config.get('JWT_ACCESS_TOKEN_EXPIRES'))
+        return state
+
+    def is_revoked(self, jti):
+        """
+        Check whether a token id has been revoked
+        :param jti:
+        :return:
+        """
+        state = self._state()
+        if state.recent.get(jti):
+            return True
+        if jti not in state.bloom:
+            return False
+        # Either revoked or a false positive, the primary decides
+        with db.primary():
+            revoked = RevokedTokens.is_jti_blacklisted(jti)
+        if revoked:
+            state.recent.set(jti, True)
+            return True
+        return False
+
+    def add(self, jti):
+        """
+        Record a revocation made by this worker so it applies immediately
+        :param jti:
+        :return:
+        """
+        state = self._state()
+        state.bloom.add(jti)
+        state.recent.set(jti, True)
+
+
+class ResponseCache(object):
+    """
+    Cache of rendered responses for the public catalogue reads.
+
+    RESPONSE_CACHE_TYPE picks the backend: 'lru' keeps entries in this
+    worker, 'file' shares them between workers through RESPONSE_CACHE_DIR
+    and None turns the cache off. Both hold at most RESPONSE_CACHE_SIZE
+    entries and the LRU at most RESPONSE_CACHE_MAX_BYTES of bodies. Keys
+    carry the catalogue version, so a write made by any worker makes older
+    entries unreachable; the worker that made it also clears the backend
+    once its transaction commits. Only the paging arguments are part of
+    the key, requests with any other argument bypass the cache.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_TYPE', 'lru')
+        app.config.setdefault('RESPONSE_CACHE_SIZE', 1024)
+        app.config.setdefault('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        app.config.setdefault('RESPONSE_CACHE_TTL', 300)
+        app.config.setdefault('RESPONSE_CACHE_DIR', None)
+
+        cache_type = app.config['RESPONSE_CACHE_TYPE']
+        if cache_type == 'lru':
+            backend = LRUCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'],
+                               app.config['RESPONSE_CACHE_MAX_BYTES'], weigh=lambda entry: len(entry[2]))
+        elif cache_type == 'file':
+            if not app.config['RESPONSE_CACHE_DIR']:
+                raise ValueError('RESPONSE_CACHE_DIR must be set for the file response cache')
+            backend = FileCache(app.config['RESPONSE_CACHE_DIR'], app.config['RESPONSE_CACHE_TTL'],
+                                app.config['RESPONSE_CACHE_SIZE'])
+        elif cache_type is None:
+            backend = None
+        else:
+            raise ValueError('RESPONSE_CACHE_TYPE must be lru, file or None')
+        app.extensions['response_cache'] = backend
+
+    @staticmethod
+    def stats():
+        """
+        Return the hit and miss counters of this worker
+        :return:
+        """
+        backend = current_app.extensions.get('response_cache')
+        if backend is None:
+            return {'backend': None}
+        return {
+            'backend': current_app.config['RESPONSE_CACHE_TYPE'],
+            'entries': len(backend),
+            'hits': backend.hits,
+            'misses': backend.misses
+        }
+
+
+class FragmentCache(object):
+    """
+    Cache of the encoded JSON of single rows.
+
+    Models opt in with a fragment_key property that changes whenever the
+    row does, so stale fragments are never looked up again and simply age
+    out of the LRU. FRAGMENT_CACHE_SIZE of 0 turns the cache off.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 10000)
+        size = app.config['FRAGMENT_CACHE_SIZE']
+        app.extensions['fragment_cache'] = LRUCache(size) if size else None
+
+
+# Stands in for the results while the envelope is encoded; an encoded string
+# cannot occur inside another one since its quotes would be escaped
+_RESULTS_PLACEHOLDER = '__results_fragments__'
+
+
+def encode_fragments(items):
+    """
+    Return the JSON of each item's serialize as bytes, encoding every row
+    version at most once
+    :param items:
+    :return:
+    """
+    cache = current_app.extensions.get('fragment_cache')
+    fragments = []
+    for item in items:
+        key = getattr(item, 'fragment_key', None)
+        fragment = cache.get(key) if cache is not None and key is not None else None
+        if fragment is None:
+            fragment = dumps(item.serialize)
+            if cache is not None and key is not None:
+                cache.set(key, fragment)
+        fragments.append(fragment)
+    return fragments
+
+
+def fragments_response(items, envelope=None, status=200):
+    """
+    Build a JSON response by joining the fragments of items.
+    With an envelope the items are added to it as results.
+    :param items: a list of rows, or a single row
+    :param envelope: a dict of the other keys of the response
+    :param status:
+    :return:
+    """
+    if isinstance(items, (list, tuple)):
+        body = b'[' + b','.join(encode_fragments(items)) + b']'
+    else:
+        body = encode_fragments([items])[0]
+
+    if envelope is not None:
+        # The encoder places and spaces the results key, the fragments replace its placeholder
+        document = dumps(dict(envelope, results=_RESULTS_PLACEHOLDER))
+        body = document.replace(dumps(_RESULTS_PLACEHOLDER), body, 1)
+    return current_app.response_class(body + b'\n', status=status, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+@event.listens_for(Book, 'after_delete')
+def _forget_fragment(mapper, connection, target):
+    if has_app_context():
+        cache = current_app.extensions.get('fragment_cache')
+        if cache is not None:
+            cache.delete(target.fragment_key)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _clear_responses(session):
+    if session.info.pop('catalogue_changed', False) and has_app_context():
+        backend = current_app.extensions.get('response_cache')
+        if backend is not None:
+            backend.clear()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _forget_catalogue_change(session, previous_transaction):
+    session.info.pop('catalogue_changed', None)
@@ -1,31 +1,88 @@
-import json
-from functools import wraps
-from flask import request, jsonify
-from .models import get_paginated, User
-from flask_jwt_extended import get_jwt_identity
+import hashlib
+from functools import partial, wraps
+from math import ceil
+from urllib.parse import urlencode
+from flask import current_app, g, request
+from sqlalchemy.orm import Query
+from .auth import get_current_user
+from .cache import fragments_response
+from .encoders import jsonify
+from .models import CatalogueVersion, get_cursor_paginated, get_paginated, page_limit, page_number
 
+# Page size used by cursor pagination when no limit is given
+DEFAULT_CURSOR_LIMIT = 20
 
-def allow_pagination(func):
+
+def _page_url():
+    """
+    Current path plus any query arguments that are not pagination controls
+    :return:
+    """
+    args = [(key, value) for key, value in request.args.items(multi=True)
+            if key not in ('page', 'limit', 'cursor')]
+    if args:
+        return request.path + '?' + urlencode(args)
+    return request.path
+
+
+def catalogue_version():
+    """
+    Return the catalogue (version, updated_at), read at most once per request
+    :return:
+    """
+    if 'catalogue_version' not in g:
+        g.catalogue_version = CatalogueVersion.current()
+    return g.catalogue_version
+
+
+def allow_pagination(func=None, default_limit=None, cursor=True):
     """
-    Decorator for paginating results
+    Decorator for paginating results.
+    The wrapped view returns a query; only the requested page is loaded
+    and its rows' cached JSON fragments are joined into the response. Any
+    other return value is passed through untouched.
+    Passing a cursor parameter (empty for the first page) switches to
+    keyset pagination, otherwise page and limit are used. Views given a
+    default_limit are always paginated. Views ordering their results other
+    than by the model's cursor_columns pass cursor=False and refuse cursors.
     :param func:
+    :param default_limit:
+    :param cursor: whether keyset pagination is offered
     :return:
     """
+    if func is None:
+        return partial(allow_pagination, default_limit=default_limit, cursor=cursor)
 
     @wraps(func)
     def paginate(*args, **kwargs):
-        limit = request.args.get('limit')
-        page = 1 if not request.args.get('page') else request.args.get('page')
+        # Bad values are refused before the query runs; a negative page or
+        # a zero limit would otherwise load the whole table or divide by zero
+        try:
+            limit = page_limit(request.args['limit']) if request.args.get('limit') else default_limit
+            page = page_number(request.args['page']) if request.args.get('page') else 1
+        except ValueError as e:
+            return jsonify(message=str(e)), 400
+        if 'cursor' in request.args and not cursor:
+            return jsonify(message='This resource does not support cursor pagination'), 400
 
-        rv = func(*args, **kwargs)[0]
-        results = json.loads(rv.data)
+        rv = func(*args, **kwargs)
+        if not isinstance(rv, Query):
+            return rv
+
+        if 'cursor' in request.args:
+            try:
+                paginated = get_cursor_paginated(limit or DEFAULT_CURSOR_LIMIT, rv, _page_url(),
+                                                 request.args.get('cursor'))
+            except ValueError:
+                return jsonify(message='Invalid cursor'), 400
+            return fragments_response(paginated.pop('results'), paginated)
 
         if limit:
-            paginated = get_paginated(limit, results, request.path, page)
+            paginated = get_paginated(limit, rv, _page_url(), page)
             if not paginated:
                 return jsonify(message='The requested page was not found'), 404
-            return jsonify(paginated), 200
-        return func(*args, **kwargs)
+            return fragments_response(paginated.pop('results'), paginated)
+        return fragments_response(rv.all())
 
     return paginate
 
@@ -39,9 +96,142 @@ def admin_user(func):
 
     @wraps(func)
     def check_admin_status(*args, **kwargs):
-        current_user_email = get_jwt_identity()
-        user = User.get_user_by_email(current_user_email)
+        user = get_current_user()
         if not user.is_admin:
             return jsonify(message='You are not authorized to access this resource.'), 401
         return func(*args, **kwargs)
     return check_admin_status
+
+
+def catalogue_etag(func):
+    """
+    Decorator answering conditional GETs on catalogue reads.
+    The ETag is derived from the catalogue version and the requested URL,
+    so a matching If-None-Match gets a 304 without the view running.
+    :param func:
+    :return:
+    """
+
+    @wraps(func)
+    def check_etag(*args, **kwargs):
+        version, updated_at = catalogue_version()
+        etag = hashlib.sha1('{}:{}'.format(version, request.full_path).encode('utf-8')).hexdigest()
+        if updated_at is not None:
+            updated_at = updated_at.replace(microsecond=0)
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            since = request.if_modified_since
+            not_modified = since is not None and updated_at is not None and updated_at <= since.replace(tzinfo=None)
+
+        if not_modified:
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        if updated_at is not None:
+            response.last_modified = updated_at
+        return response
+
+    return check_etag
+
+
+# The only query arguments a cached response may depend on
+CACHE_KEY_ARGS = ('page', 'limit', 'cursor')
+
+
+def _response_cache_key():
+    """
+    Cache key for the current request: catalogue version, path and the
+    normalized paging arguments. Returns None when other arguments are
+    present or the paging arguments cannot be normalized, so those
+    requests skip the cache and cannot fill it with variants.
+    :return:
+    """
+    args = request.args
+    if any(key not in CACHE_KEY_ARGS for key in args) or any(len(args.getlist(key)) > 1 for key in args):
+        return None
+    try:
+        limit = page_limit(args['limit']) if args.get('limit') else None
+        page = page_number(args['page']) if args.get('page') else 1
+    except ValueError:
+        return None
+
+    key = []
+    if 'cursor' in args:
+        key.append(('cursor', args['cursor']))
+    if limit:
+        key.extend([('limit', limit), ('page', page)])
+    return '{}:{}?{}'.format(catalogue_version()[0], request.path, urlencode(key))
+
+
+def cached_response(func):
+    """
+    Decorator serving successful responses of public catalogue reads from
+    the response cache. Responses carry X-Cache: HIT or MISS.
+    :param func:
+    :return:
+    """
+
+    @wraps(func)
+    def serve_cached(*args, **kwargs):
+        cache = current_app.extensions.get('response_cache')
+        key = _response_cache_key() if cache is not None else None
+        if key is None:
+            return func(*args, **kwargs)
+
+        entry = cache.get(key)
+        if entry is not None:
+            status, mimetype, body = entry
+            response = current_app.response_class(body, status=status, mimetype=mimetype)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        response = current_app.make_response(func(*args, **kwargs))
+        if response.status_code == 200:
+            cache.set(key, (response.status_code, response.mimetype, response.get_data()))
+            response.headers['X-Cache'] = 'MISS'
+        return response
+
+    return serve_cached
+
+
+def _rate_limit_subject(scope):
+    if scope == 'ip':
+        return request.remote_addr
+    data = request.get_json(silent=True)
+    email = data.get('email') if isinstance(data, dict) else None
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
+
+
+def rate_limited(func):
+    """
+    Decorator applying the endpoint's RATE_LIMITS.
+    Requests over a limit get a 429 before the view runs, so they cost
+    neither a user lookup nor a password hash.
+    :param func:
+    :return:
+    """
+
+    @wraps(func)
+    def check_rate_limit(*args, **kwargs):
+        limits, store = current_app.extensions['rate_limiter']
+        buckets = []
+        for scope, (capacity, rate) in limits.get(request.endpoint, ()):
+            subject = _rate_limit_subject(scope)
+            if subject is not None:
+                buckets.append(('{}:{}:{}'.format(request.endpoint, scope, subject), capacity, rate))
+        # A request refused by one bucket takes no token from the others, so a
+        # client over its own limit cannot drain the buckets of someone's email
+        wait = store.consume_all(buckets) if buckets else 0
+        if wait:
+            retry_after = str(int(ceil(wait)))
+            return jsonify({'message': 'Too many attempts. Try again in {} seconds.'.format(retry_after)}), \
+                429, {'Retry-After': retry_after}
+        return func(*args, **kwargs)
+
+    return check_rate_limit
@@ -0,0 +1,174 @@
+"""
+JSON encoding of responses.
+
+orjson is used when it is installed, the stdlib json module otherwise.
+Both produce the same documents: keys sorted as JSON_SORT_KEYS says and
+dates written as HTTP dates, the way Flask's own encoder writes them.
+"""
+import json
+from datetime import date, datetime
+from functools import lru_cache
+
+from flask import current_app, request
+from flask_api.renderers import BaseRenderer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+ENCODERS = ('auto', 'orjson', 'stdlib')
+
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def _http_date(o):
+    """
+    Format a date or datetime like werkzeug's http_date, without building a time tuple
+    :param o:
+    :return:
+    """
+    if isinstance(o, datetime):
+        hour, minute, second = o.hour, o.minute, o.second
+    else:
+        hour = minute = second = 0
+    return '{}, {:02d} {} {:04d} {:02d}:{:02d}:{:02d} GMT'.format(
+        _WEEKDAYS[o.weekday()], o.day, _MONTHS[o.month], o.year, hour, minute, second)
+
+
+# Plain dates repeat a lot across a listing (borrowed today, due in six days)
+_http_day = lru_cache(maxsize=4096)(_http_date)
+
+
+def http_date(o):
+    """
+    Format a date or datetime the way the encoders write it, None stays None.
+    Serializers use it so orjson encodes their dates as plain strings.
+    :param o:
+    :return:
+    """
+    if o is None:
+        return None
+    if isinstance(o, datetime):
+        return _http_date(o)
+    return _http_day(o)
+
+
+def _default(o):
+    if isinstance(o, date):
+        return http_date(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
+
+def stdlib_dumps(obj, sort_keys=True, indent=None):
+    """
+    Encode obj to JSON bytes with the stdlib json module
+    :param obj:
+    :param sort_keys:
+    :param indent:
+    :return:
+    """
+    return json.dumps(obj, default=_default, sort_keys=sort_keys, indent=indent,
+                      ensure_ascii=False).encode('utf-8')
+
+
+def orjson_dumps(obj, sort_keys=True, indent=None):
+    """
+    Encode obj to JSON bytes with orjson
+    :param obj:
+    :param sort_keys:
+    :param indent:
+    :return:
+    """
+    if indent not in (None, 0, 2):
+        # orjson only indents by two spaces
+        return stdlib_dumps(obj, sort_keys, indent)
+
+    # Serializers format their dates with http_date; any other date is
+    # passed to _default so it keeps the HTTP date format
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=_default, option=option)
+
+
+class ResponseEncoder(object):
+    """
+    Picks the JSON encoder used for every response.
+
+    JSON_ENCODER is 'auto' (orjson when installed), 'orjson' or 'stdlib'.
+    Dict and list returns are rendered through JSONRenderer and views use
+    the jsonify of this module.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JSON_ENCODER', 'auto')
+        app.config.setdefault('DEFAULT_RENDERERS', [
+            'api.encoders.JSONRenderer',
+            'flask_api.renderers.BrowsableAPIRenderer'
+        ])
+
+        encoder = app.config['JSON_ENCODER']
+        if encoder not in ENCODERS:
+            raise ValueError('JSON_ENCODER must be one of: {}'.format(', '.join(ENCODERS)))
+        if encoder == 'orjson' and orjson is None:
+            raise RuntimeError('JSON_ENCODER is orjson but orjson is not installed')
+        use_orjson = orjson is not None and encoder != 'stdlib'
+        app.extensions['json_encoder'] = orjson_dumps if use_orjson else stdlib_dumps
+
+
+def dumps(obj, indent=None):
+    """
+    Encode obj to JSON bytes with the app's encoder
+    :param obj:
+    :param indent:
+    :return:
+    """
+    encode = current_app.extensions.get('json_encoder', stdlib_dumps)
+    return encode(obj, sort_keys=current_app.config['JSON_SORT_KEYS'], indent=indent)
+
+
+def jsonify(*args, **kwargs):
+    """
+    Drop-in replacement for flask.jsonify using the app's encoder
+    :param args:
+    :param kwargs:
+    :return:
+    """
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    data = args[0] if len(args) == 1 else (args or kwargs)
+
+    indent = None
+    if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] and not request.is_xhr:
+        indent = 2
+    return current_app.response_class(dumps(data, indent=indent) + b'\n',
+                                      mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+class JSONRenderer(BaseRenderer):
+    """
+    FlaskAPI renderer for dict and list returns using the app's encoder.
+    """
+    media_type = 'application/json'
+    charset = None
+
+    def render(self, data, media_type, **options):
+        # Requested indentation may be set in the Accept header.
+        try:
+            indent = max(min(int(media_type.params['indent']), 8), 0)
+        except (KeyError, ValueError, TypeError):
+            indent = None
+        indent = options.get('indent', indent)
+        # The browsable API renderer expects text, like FlaskAPI's own renderer returns
+        return dumps(data, indent=indent).decode('utf-8')
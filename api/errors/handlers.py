@@ -1,7 +1,7 @@
-from flask import jsonify
-
 from . import errors
-from api import jwt, RevokedTokens
+from api import jwt, revocation_cache
+from api.encoders import jsonify
+from api.passwords import HashingBusy
 
 
 @errors.app_errorhandler(404)
@@ -33,10 +33,16 @@ def error_500(e):
     return jsonify({"message": "The resource you are trying to access is not allowed for this requested URL."}), 500
 
 
+@errors.app_errorhandler(HashingBusy)
+def error_hashing_busy(e):
+    return jsonify({"message": "Hello Books is handling too many logins right now. " +
+                               "Kindly try again shortly"}), 503, {"Retry-After": "1"}
+
+
 @jwt.token_in_blacklist_loader
 def check_if_token_in_blacklist(decrypted_token):
     jti = decrypted_token['jti']
-    return RevokedTokens.is_jti_blacklisted(jti)
+    return revocation_cache.is_revoked(jti)
 
 
 @jwt.expired_token_loader
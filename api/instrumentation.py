@@ -0,0 +1,129 @@
+"""
+Per-request database instrumentation.
+
+Every request records how many statements it ran, the time they took
+and the rows the driver reported (rows changed, and on PostgreSQL also
+rows returned by SELECTs). Statements slower than SLOW_QUERY_THRESHOLD
+seconds are logged with the endpoint that ran them, and requests running
+more than REQUEST_QUERY_WARNING statements are logged as well.
+With SERVER_TIMING_HEADER the numbers are sent in a Server-Timing header
+that browser developer tools display.
+
+The engine hooks only time statements and add to the counters of the
+current request, so the instrumentation can stay on in production.
+"""
+import logging
+import threading
+import time
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# The counters of the request handled by this thread, None between requests
+_local = threading.local()
+
+_hooks_lock = threading.Lock()
+_hooks_installed = False
+
+
+class RequestStats(object):
+    """
+    Database counters of one request.
+    """
+    __slots__ = ('endpoint', 'started', 'queries', 'db_time', 'rows', 'slow_query')
+
+    def __init__(self, endpoint, slow_query):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.slow_query = slow_query
+
+
+def request_stats():
+    """
+    The counters of the current request, None outside a request
+    :return:
+    """
+    return getattr(_local, 'stats', None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and getattr(_local, 'stats', None) is not None:
+        context.query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_local, 'stats', None)
+    started = getattr(context, 'query_started', None)
+    if stats is None or started is None:
+        return
+    elapsed = time.perf_counter() - started
+    stats.queries += 1
+    stats.db_time += elapsed
+    if cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+    if stats.slow_query and elapsed >= stats.slow_query:
+        logger.warning('Slow query in %s took %.3fs: %s', stats.endpoint, elapsed, statement)
+
+
+def _install_hooks():
+    """
+    Listen to the statements of every engine, including replicas, once per process
+    :return:
+    """
+    global _hooks_installed
+    with _hooks_lock:
+        if not _hooks_installed:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            _hooks_installed = True
+
+
+class QueryInstrumentation(object):
+    """
+    Collects the database counters of an app's requests.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('INSTRUMENTATION_ENABLED', True)
+        app.config.setdefault('SLOW_QUERY_THRESHOLD', 0.5)
+        app.config.setdefault('REQUEST_QUERY_WARNING', 30)
+        app.config.setdefault('SERVER_TIMING_HEADER', False)
+        if not app.config['INSTRUMENTATION_ENABLED']:
+            return
+
+        _install_hooks()
+
+        @app.before_request
+        def start_request_stats():
+            _local.stats = RequestStats(request.endpoint, app.config['SLOW_QUERY_THRESHOLD'])
+
+        @app.after_request
+        def report_request_stats(response):
+            stats = request_stats()
+            if stats is None:
+                return response
+            elapsed = time.perf_counter() - stats.started
+            logger.debug('%s ran %s queries returning %s rows in %.1fms of %.1fms', stats.endpoint,
+                         stats.queries, stats.rows, stats.db_time * 1000, elapsed * 1000)
+            query_warning = app.config['REQUEST_QUERY_WARNING']
+            if query_warning and stats.queries > query_warning:
+                logger.warning('%s ran %s queries', stats.endpoint, stats.queries)
+            if app.config['SERVER_TIMING_HEADER']:
+                response.headers.add('Server-Timing', 'db;dur={:.2f};desc="{} queries, {} rows"'.format(
+                    stats.db_time * 1000, stats.queries, stats.rows))
+                response.headers.add('Server-Timing', 'app;dur={:.2f}'.format(elapsed * 1000))
+            return response
+
+        @app.teardown_request
+        def clear_request_stats(exc):
+            _local.stats = None
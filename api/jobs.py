@@ -0,0 +1,223 @@
+"""
+Periodic maintenance jobs.
+
+`python manage.py worker` queues the housekeeping jobs listed in
+PERIODIC_JOBS (name: seconds between runs) and runs them off the request
+path. No request queues work: logouts and password resets revoke their
+token at once, and the rows they leave behind are pruned here. A job is
+a row of the jobs table, so no broker is needed, and enqueue() adds one
+to the caller's transaction. Failed jobs are retried JOB_MAX_ATTEMPTS
+times with a growing delay.
+"""
+import json
+import logging
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+
+from .models import ActiveTokens, Job, RevokedTokens, db
+from .overdue import process_overdue
+
+logger = logging.getLogger(__name__)
+
+# Job functions by name, filled by the job decorator
+JOBS = {}
+
+
+class JobQueue(object):
+    """
+    Configures the job queue of an app.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PERIODIC_JOBS', {
+            'prune_revoked_tokens': 3600,
+            'prune_active_tokens': 3600,
+            'flag_overdue_loans': 600,
+            'prune_jobs': 3600
+        })
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 3)
+        app.config.setdefault('JOB_RETRY_DELAY', 30)
+        app.config.setdefault('JOB_POLL_INTERVAL', 1)
+        app.config.setdefault('JOB_RETENTION', 86400)
+
+
+def job(name):
+    """
+    Decorator registering a function as the job called name
+    :param name:
+    :return:
+    """
+    def register(func):
+        JOBS[name] = func
+        return func
+    return register
+
+
+def enqueue(name, delay=0, **payload):
+    """
+    Queue a job as part of the caller's transaction
+    :param name:
+    :param delay: seconds to wait before the job may run
+    :param payload: keyword arguments for the job, must be JSON serializable
+    :return:
+    """
+    if name not in JOBS:
+        raise ValueError('Unknown job: {}'.format(name))
+    queued = Job(name=name, payload=json.dumps(payload), run_at=datetime.now() + timedelta(seconds=delay))
+    db.session.add(queued)
+    return queued
+
+
+def _claim():
+    """
+    Take the next job that is due. A conditional UPDATE makes sure only one
+    worker gets a job when several poll the same queue.
+    :return:
+    """
+    due = db.session.query(Job.id) \
+        .filter(Job.status == 'queued', Job.run_at <= datetime.now()) \
+        .order_by(Job.run_at, Job.id) \
+        .limit(10).all()
+    db.session.commit()
+    for job_id, in due:
+        claimed = Job.query.filter_by(id=job_id, status='queued') \
+            .update({'status': 'running', 'attempts': Job.attempts + 1}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return Job.query.get(job_id)
+    return None
+
+
+def run_job(queued):
+    """
+    Run a claimed job and record its outcome
+    :param queued:
+    :return:
+    """
+    name, job_id = queued.name, queued.id
+    try:
+        JOBS[name](**json.loads(queued.payload))
+    except Exception:
+        db.session.rollback()
+        queued = Job.query.get(job_id)
+        queued.last_error = traceback.format_exc()
+        if queued.attempts >= current_app.config['JOB_MAX_ATTEMPTS']:
+            queued.status = 'failed'
+            queued.finished_at = datetime.now()
+            logger.exception('Job %s (%s) failed', name, job_id)
+        else:
+            delay = current_app.config['JOB_RETRY_DELAY'] * 2 ** (queued.attempts - 1)
+            queued.status = 'queued'
+            queued.run_at = datetime.now() + timedelta(seconds=delay)
+            logger.warning('Job %s (%s) failed, retrying in %s seconds', name, job_id, delay)
+    else:
+        queued = Job.query.get(job_id)
+        queued.status = 'done'
+        queued.finished_at = datetime.now()
+    db.session.commit()
+
+
+def run_pending():
+    """
+    Run every job that is due
+    :return: the number of jobs run
+    """
+    count = 0
+    queued = _claim()
+    while queued is not None:
+        run_job(queued)
+        count += 1
+        queued = _claim()
+    return count
+
+
+def schedule_periodic():
+    """
+    Queue the periodic jobs whose interval has passed since they last finished
+    and that are not already waiting or running
+    :return:
+    """
+    now = datetime.now()
+    for name, interval in current_app.config['PERIODIC_JOBS'].items():
+        pending = db.session.query(Job.id) \
+            .filter(Job.name == name, Job.status.in_(('queued', 'running'))).first()
+        if pending is not None:
+            continue
+        last_run = db.session.query(func.max(Job.finished_at)).filter(Job.name == name).scalar()
+        if last_run is None or last_run <= now - timedelta(seconds=interval):
+            enqueue(name)
+    db.session.commit()
+
+
+def work(once=False):
+    """
+    Worker loop: schedule periodic jobs and run due jobs, sleeping
+    JOB_POLL_INTERVAL seconds whenever the queue is empty
+    :param once: stop after the first pass
+    :return:
+    """
+    while True:
+        schedule_periodic()
+        ran = run_pending()
+        if once:
+            return ran
+        if not ran:
+            time.sleep(current_app.config['JOB_POLL_INTERVAL'])
+
+
+@job('prune_revoked_tokens')
+def prune_revoked_tokens():
+    """
+    Delete revocations of tokens that have expired anyway
+    :return:
+    """
+    lifetime = current_app.config.get('JWT_ACCESS_TOKEN_EXPIRES')
+    if not lifetime:
+        # Tokens never expire, so their revocations must be kept
+        return
+    # Keep a margin for the revocation cache's refresh overlap
+    cutoff = datetime.now() - lifetime - timedelta(minutes=5)
+    pruned = RevokedTokens.query.filter(RevokedTokens.time_revoked < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    logger.info('Pruned %s revoked tokens', pruned)
+
+
+@job('prune_active_tokens')
+def prune_active_tokens():
+    """
+    Delete active token records that ActiveTokens.token_is_expired considers expired
+    :return:
+    """
+    cutoff = datetime.now() - timedelta(minutes=60)
+    ActiveTokens.query.filter(ActiveTokens.time_created < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+
+@job('flag_overdue_loans')
+def flag_overdue_loans():
+    """
+    Flag open loans that fell due since the last run
+    :return:
+    """
+    flagged = process_overdue()
+    logger.info('Flagged %s overdue loans', flagged)
+
+
+@job('prune_jobs')
+def prune_jobs():
+    """
+    Delete finished jobs older than JOB_RETENTION seconds
+    :return:
+    """
+    cutoff = datetime.now() - timedelta(seconds=current_app.config['JOB_RETENTION'])
+    Job.query.filter(Job.status.in_(('done', 'failed')), Job.finished_at < cutoff) \
+        .delete(synchronize_session=False)
+    db.session.commit()
@@ -0,0 +1,431 @@
+"""
+Prometheus metrics.
+
+GET /metrics returns, in the text exposition format, request counts and
+latency histograms per blueprint and endpoint, response status counts
+(responses of the error handlers included), response cache hits and
+misses, the queries run per endpoint and the database pool gauges.
+
+Without METRICS_DIR every worker reports only its own requests. With
+METRICS_DIR each worker process writes its values to its own mmap'd
+file in that directory and /metrics adds up the files of all workers,
+so any worker answers for the whole server. Empty the directory before
+the server starts, since the files of earlier runs would be counted too.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import Response, g, request
+
+from .instrumentation import request_stats
+from .models import InstrumentedQueuePool, db
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help). Counters add up over every process that ever wrote
+# them, gauges only over the processes still running.
+METRICS = {
+    'hellobooks_http_requests_total': (
+        'counter', 'Requests by blueprint, endpoint, method and response status'),
+    'hellobooks_http_request_duration_seconds': (
+        'histogram', 'Time spent handling requests by blueprint and endpoint'),
+    'hellobooks_response_cache_requests_total': (
+        'counter', 'Response cache lookups by endpoint and result'),
+    'hellobooks_db_queries_total': (
+        'counter', 'Database statements run by endpoint'),
+    'hellobooks_db_query_seconds_total': (
+        'counter', 'Time spent in database statements by endpoint'),
+    'hellobooks_db_pool_size': (
+        'gauge', 'Connections the pool keeps open'),
+    'hellobooks_db_pool_checked_out': (
+        'gauge', 'Connections in use'),
+    'hellobooks_db_pool_overflow': (
+        'gauge', 'Connections open beyond the pool size'),
+    'hellobooks_db_pool_checkouts_total': (
+        'counter', 'Connections taken from the pool'),
+    'hellobooks_db_pool_timeouts_total': (
+        'counter', 'Checkouts that gave up waiting for a connection'),
+    'hellobooks_db_pool_wait_seconds_total': (
+        'counter', 'Time spent waiting for a connection'),
+}
+
+# Seconds between two updates of a worker's pool gauges
+POOL_UPDATE_INTERVAL = 1
+
+_HEADER = struct.Struct('i')
+_LENGTH = struct.Struct('i')
+_VALUE = struct.Struct('d')
+
+
+def _encode_key(key):
+    name, labels = key
+    return json.dumps([name, labels]).encode('utf-8')
+
+
+def _decode_key(raw):
+    name, labels = json.loads(raw.decode('utf-8'))
+    return name, tuple(tuple(label) for label in labels)
+
+
+def _entries(data, used):
+    """
+    Iterate the (key, value, value offset) entries of a metrics file
+    :param data:
+    :param used:
+    :return:
+    """
+    position = 8
+    while position < used:
+        length, = _LENGTH.unpack_from(data, position)
+        raw = bytes(data[position + 4:position + 4 + length])
+        position += 4 + length
+        position += -position % 8
+        value, = _VALUE.unpack_from(data, position)
+        yield _decode_key(raw), value, position
+        position += 8
+
+
+class MemoryStore(object):
+    """
+    Metric values of this process only.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, items):
+        """
+        Add amounts to values
+        :param items: (key, amount) pairs
+        :return:
+        """
+        with self._lock:
+            for key, amount in items:
+                self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, items):
+        """
+        Replace values
+        :param items: (key, value) pairs
+        :return:
+        """
+        with self._lock:
+            self._values.update(items)
+
+    def collect(self):
+        """
+        The values of every process as (pid, alive, values) triples
+        :return:
+        """
+        with self._lock:
+            return [(os.getpid(), True, dict(self._values))]
+
+
+class MmapStore(object):
+    """
+    Metric values of every worker in a directory of mmap'd files.
+
+    A worker only writes its own file, named after its pid, so writes need
+    no locking between processes. A file is a 4 byte count of the bytes in
+    use, padding, then entries of a 4 byte key length, the JSON key padded
+    to 8 bytes and the value as a double.
+    """
+
+    INITIAL_SIZE = 1 << 16
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        # Called again after a fork, so that every worker gets its own file
+        self._pid = os.getpid()
+        path = os.path.join(self.directory, '{}.metrics'.format(self._pid))
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self.INITIAL_SIZE:
+            self._file.truncate(self.INITIAL_SIZE)
+            size = self.INITIAL_SIZE
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._used = _HEADER.unpack_from(self._map, 0)[0] or 8
+        # A file left by an earlier process with the same pid is carried on
+        self._positions = {key: position for key, _, position in _entries(self._map, self._used)}
+
+    def _position(self, key):
+        position = self._positions.get(key)
+        if position is not None:
+            return position
+        raw = _encode_key(key)
+        start = self._used + 4 + len(raw)
+        position = start + -start % 8
+        if position + 8 > len(self._map):
+            size = len(self._map)
+            while position + 8 > size:
+                size *= 2
+            self._map.close()
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+        _LENGTH.pack_into(self._map, self._used, len(raw))
+        self._map[self._used + 4:self._used + 4 + len(raw)] = raw
+        _VALUE.pack_into(self._map, position, 0.0)
+        # Readers only look at entries below the count, so it is written last
+        self._used = position + 8
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def inc(self, items):
+        """
+        Add amounts to values
+        :param items: (key, amount) pairs
+        :return:
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            for key, amount in items:
+                position = self._position(key)
+                _VALUE.pack_into(self._map, position, _VALUE.unpack_from(self._map, position)[0] + amount)
+
+    def set(self, items):
+        """
+        Replace values
+        :param items: (key, value) pairs
+        :return:
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            for key, value in items:
+                _VALUE.pack_into(self._map, self._position(key), value)
+
+    def collect(self):
+        """
+        The values of every process as (pid, alive, values) triples
+        :return:
+        """
+        processes = []
+        for filename in sorted(os.listdir(self.directory)):
+            pid, _, extension = filename.partition('.')
+            if extension != 'metrics' or not pid.isdigit():
+                continue
+            with open(os.path.join(self.directory, filename), 'rb') as metrics_file:
+                data = metrics_file.read()
+            if len(data) < 8:
+                continue
+            used = _HEADER.unpack_from(data, 0)[0]
+            values = {key: value for key, value, _ in _entries(data, used)}
+            processes.append((int(pid), _alive(int(pid)), values))
+        return processes
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# One MmapStore per directory, shared by the apps of a process
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _store_for(directory):
+    with _stores_lock:
+        if directory not in _stores:
+            os.makedirs(directory, exist_ok=True)
+            _stores[directory] = MmapStore(directory)
+        return _stores[directory]
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def aggregate(processes):
+    """
+    Add up the values of all processes, leaving out the gauges of those that exited
+    :param processes:
+    :return:
+    """
+    totals = {}
+    for _, alive, values in processes:
+        for key, value in values.items():
+            kind = METRICS.get(key[0], ('counter',))[0]
+            if kind == 'gauge' and not alive:
+                continue
+            totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def exposition(totals, buckets=DEFAULT_BUCKETS):
+    """
+    Write metric values in the Prometheus text format
+    :param totals:
+    :param buckets:
+    :return:
+    """
+    lines = []
+    for name in sorted(METRICS):
+        kind, help_text = METRICS[name]
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind != 'histogram':
+            for (metric, labels), value in sorted(totals.items()):
+                if metric == name:
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+            continue
+
+        # Buckets are stored one count per bucket and reported cumulatively
+        series = sorted(labels for metric, labels in totals if metric == name + '_count')
+        for labels in series:
+            cumulative = 0.0
+            for bound in buckets:
+                cumulative += totals.get((name + '_bucket', labels + (('le', _format_value(bound)),)), 0.0)
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', _format_value(bound)),)),
+                                                     _format_value(cumulative)))
+            count = totals[(name + '_count', labels)]
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', '+Inf'),)),
+                                                 _format_value(count)))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels),
+                                              _format_value(totals.get((name + '_sum', labels), 0.0))))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), _format_value(count)))
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsState(object):
+    """
+    The store and the recording settings of one app.
+    """
+
+    def __init__(self, store, buckets):
+        self.store = store
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_labels = tuple(('le', _format_value(bound)) for bound in self.buckets)
+        self.pool_updated = 0
+
+    def record(self, response_status, cache_result=None):
+        """
+        Count the current request
+        :param response_status:
+        :param cache_result: HIT or MISS when the response cache was used
+        :return:
+        """
+        elapsed = time.perf_counter() - g.metrics_started
+        endpoint = request.endpoint or 'unknown'
+        labels = (('blueprint', request.blueprint or ''), ('endpoint', endpoint))
+        bucket = next((label for bound, label in zip(self.buckets, self.bucket_labels) if elapsed <= bound), None)
+
+        items = [
+            (('hellobooks_http_requests_total', labels + (('method', request.method),
+                                                         ('status', str(response_status)))), 1),
+            (('hellobooks_http_request_duration_seconds_count', labels), 1),
+            (('hellobooks_http_request_duration_seconds_sum', labels), elapsed)
+        ]
+        if bucket is not None:
+            items.append((('hellobooks_http_request_duration_seconds_bucket', labels + (bucket,)), 1))
+        if cache_result in ('HIT', 'MISS'):
+            items.append((('hellobooks_response_cache_requests_total',
+                           (('endpoint', endpoint), ('result', cache_result.lower()))), 1))
+        stats = request_stats()
+        if stats is not None and stats.queries:
+            items.append((('hellobooks_db_queries_total', (('endpoint', endpoint),)), stats.queries))
+            items.append((('hellobooks_db_query_seconds_total', (('endpoint', endpoint),)), stats.db_time))
+        self.store.inc(items)
+
+        now = time.monotonic()
+        if now - self.pool_updated >= POOL_UPDATE_INTERVAL:
+            self.pool_updated = now
+            self.store.set(_pool_values())
+
+
+def _pool_values():
+    """
+    The gauges and counters of the primary and replica pools that are instrumented
+    :return:
+    """
+    engines = [('primary', db.engine)]
+    engines.extend(('replica{}'.format(index), engine) for index, engine in enumerate(db.get_replica_engines()))
+    items = []
+    for database, engine in engines:
+        if not isinstance(engine.pool, InstrumentedQueuePool):
+            continue
+        labels = (('database', database),)
+        stats = engine.pool.stats()
+        items.extend([
+            (('hellobooks_db_pool_size', labels), stats['size']),
+            (('hellobooks_db_pool_checked_out', labels), stats['checked_out']),
+            (('hellobooks_db_pool_overflow', labels), max(stats['overflow'], 0)),
+            (('hellobooks_db_pool_checkouts_total', labels), stats['checkouts']),
+            (('hellobooks_db_pool_timeouts_total', labels), stats['timeouts']),
+            (('hellobooks_db_pool_wait_seconds_total', labels), stats['wait_total'])
+        ])
+    return items
+
+
+class Metrics(object):
+    """
+    Records request metrics of an app and serves them at /metrics.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_BUCKETS', DEFAULT_BUCKETS)
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        directory = app.config['METRICS_DIR']
+        store = _store_for(directory) if directory else MemoryStore()
+        state = app.extensions['metrics'] = _MetricsState(store, app.config['METRICS_BUCKETS'])
+
+        @app.before_request
+        def start_metrics():
+            g.metrics_started = time.perf_counter()
+
+        @app.after_request
+        def record_metrics(response):
+            if 'metrics_started' in g and request.endpoint != 'metrics':
+                state.record(response.status_code, response.headers.get('X-Cache'))
+                g.metrics_recorded = True
+            return response
+
+        @app.teardown_request
+        def record_failed_request(exc):
+            # Unhandled exceptions skip after_request handlers
+            if exc is not None and 'metrics_started' in g and not g.get('metrics_recorded'):
+                state.record(500)
+
+        def metrics():
+            return Response(exposition(aggregate(state.store.collect()), state.buckets),
+                            content_type=CONTENT_TYPE)
+
+        app.add_url_rule('/metrics', 'metrics', metrics)
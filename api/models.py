@@ -1,14 +1,237 @@
 """
 Contains models used in our apps.
 """
-from werkzeug.security import check_password_hash, generate_password_hash
-from datetime import datetime, timedelta
-from flask_sqlalchemy import SQLAlchemy
+import base64
+import json
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, _EngineConnector, get_state
 from math import ceil
-from sqlalchemy import desc
+from sqlalchemy import DDL, and_, desc, event, func, literal, literal_column, or_, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Query, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import GenerativeSelect
+from .encoders import http_date
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that counts checkouts and measures how long they wait for a
+    free connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+    def stats(self):
+        """
+        Current occupancy and the checkout counters of this pool
+        :return:
+        """
+        return {
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_total': round(self.wait_total, 6),
+            'wait_max': round(self.wait_max, 6)
+        }
+
+
+# Requests whose reads may be served by a replica
+REPLICA_METHODS = ('GET', 'HEAD')
+# Cookie holding the time until which a client that wrote reads from the primary
+PRIMARY_COOKIE = 'primary_until'
+
+
+class _ReplicaConnector(_EngineConnector):
+    """
+    Builds the engine of one read replica with the primary's pool options.
+    """
+
+    def __init__(self, sa, app, uri):
+        super(_ReplicaConnector, self).__init__(sa, app)
+        self._uri = uri
+
+    def get_uri(self):
+        return self._uri
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session sending the reads of GET and HEAD requests to a read replica.
+
+    Everything else goes to the primary: flushes, bulk updates, locking
+    reads, raw statements and every query outside those requests, such as
+    the worker's. Once a session has used the primary for anything but a
+    read its later reads stay there too, so a request sees its own writes.
+    A client that wrote in the last SQLALCHEMY_REPLICA_LAG seconds carries
+    the PRIMARY_COOKIE and reads from the primary as well, so it also sees
+    its writes in its next requests. A session keeps the replica it picked
+    until it is removed at the end of the request.
+    """
+
+    def __init__(self, db, **options):
+        super(RoutingSession, self).__init__(db, **options)
+        self._db = db
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, GenerativeSelect) and clause._for_update_arg is None:
+            if not self.info.get('primary') and not self.info.get('read_primary') and has_request_context() \
+                    and request.method in REPLICA_METHODS and not self._pinned():
+                replica = self._replica()
+                if replica is not None:
+                    return replica
+        else:
+            self.info['primary'] = True
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _pinned(self):
+        pinned = self.info.get('pinned')
+        if pinned is None:
+            try:
+                pinned = float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+            except ValueError:
+                pinned = False
+            self.info['pinned'] = pinned
+        return pinned
+
+    def _replica(self):
+        replica = self.info.get('replica')
+        if replica is None and self.app.config['SQLALCHEMY_REPLICA_URIS']:
+            replica = self.info['replica'] = random.choice(self._db.get_replica_engines(self.app))
+        return replica
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy taking its pool settings from the app config.
+
+    SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW, SQLALCHEMY_POOL_TIMEOUT
+    and SQLALCHEMY_POOL_RECYCLE are applied by Flask-SQLAlchemy. This adds
+    SQLALCHEMY_POOL_PRE_PING, SQLALCHEMY_STATEMENT_TIMEOUT (milliseconds,
+    PostgreSQL only) and the instrumented pool for server databases.
+
+    SQLALCHEMY_REPLICA_URIS lists read replicas of the primary, which
+    RoutingSession sends reads to. SQLALCHEMY_REPLICA_LAG is the seconds
+    a client keeps reading from the primary after it wrote.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('SQLALCHEMY_REPLICA_LAG', 5)
+        super(PooledSQLAlchemy, self).init_app(app)
+        get_state(app).replicas = {}
+
+        @app.after_request
+        def pin_to_primary(response):
+            lag = app.config['SQLALCHEMY_REPLICA_LAG']
+            if app.config['SQLALCHEMY_REPLICA_URIS'] and lag and self.session.registry.has() \
+                    and self.session().info.get('primary'):
+                response.set_cookie(PRIMARY_COOKIE, str(time.time() + lag), max_age=lag, httponly=True)
+            return response
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    @contextmanager
+    def primary(self):
+        """
+        Send the reads made inside the block to the primary, for reads that
+        must not miss a recent write however far the replicas lag
+        :return:
+        """
+        info = self.session().info
+        previous = info.get('read_primary', False)
+        info['read_primary'] = True
+        try:
+            yield
+        finally:
+            info['read_primary'] = previous
+
+    def get_replica_engines(self, app=None):
+        """
+        The engines of the configured read replicas
+        :param app:
+        :return:
+        """
+        app = self.get_app(app)
+        connectors = get_state(app).replicas
+        engines = []
+        for uri in app.config['SQLALCHEMY_REPLICA_URIS'] or ():
+            if uri not in connectors:
+                connectors[uri] = _ReplicaConnector(self, app, uri)
+            engines.append(connectors[uri].get_engine())
+        return engines
+
+    def apply_pool_defaults(self, app, options):
+        super(PooledSQLAlchemy, self).apply_pool_defaults(app, options)
+        options['pool_pre_ping'] = app.config.get('SQLALCHEMY_POOL_PRE_PING', False)
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            # SQLite keeps its own pools, which take no sizing options
+            for key in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(key, None)
+        else:
+            options.setdefault('poolclass', InstrumentedQueuePool)
+            timeout = app.config.get('SQLALCHEMY_STATEMENT_TIMEOUT')
+            if timeout and info.drivername.startswith('postgres'):
+                connect_args = options.setdefault('connect_args', {})
+                connect_args['options'] = '-c statement_timeout={:d}'.format(int(timeout))
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
 
 # Initializes Database
-db = SQLAlchemy()
+db = PooledSQLAlchemy()
+
+
+def _describe_pool(pool):
+    stats = {'pool': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update(pool.stats())
+    return stats
+
+
+def pool_stats():
+    """
+    Describe the connection pools of the current app's primary and replicas
+    :return:
+    """
+    stats = _describe_pool(db.engine.pool)
+    replicas = db.get_replica_engines()
+    if replicas:
+        stats['replicas'] = [dict(_describe_pool(engine.pool), url=repr(engine.url)) for engine in replicas]
+    return stats
 
 
 class User(db.Model):
@@ -30,27 +253,6 @@ class User(db.Model):
         self.user_password = user_password
         self.is_admin = is_admin
 
-    @staticmethod
-    def set_password(password):
-        """
-        Hashes the password
-        :param password:
-        :return:
-        """
-        return str(generate_password_hash(password))
-
-    @staticmethod
-    def check_password(password, hashed_password):
-        """
-        Checks whether hashed password matches the actual password
-        :param password:
-        :return:
-        """
-        # user_password = str(generate_password_hash(password))
-        # return check_password_hash(user_password, password)
-
-        return check_password_hash(hashed_password, password)
-
     def is_administrator(self):
         return self.is_admin is True
 
@@ -70,6 +272,14 @@ class User(db.Model):
     def get_user_by_email(email):
         return User.query.filter_by(email=email).first()
 
+    @staticmethod
+    def username_taken(username):
+        return db.session.query(User.query.filter_by(username=username).exists()).scalar()
+
+    @staticmethod
+    def email_taken(email):
+        return db.session.query(User.query.filter_by(email=email).exists()).scalar()
+
     def __repr__(self):
         return '<User: {}'.format(self.username)
 
@@ -80,6 +290,12 @@ class Book(db.Model):
     """
 
     __tablename__ = 'books'
+    # Ids of deleted books are never handed out again, they key cached fragments
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    # Columns the catalogue is ordered by, used for cursor pagination
+    cursor_columns = ('created_at', 'book_id')
+    cursor_descending = True
 
     book_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(60), nullable=False, unique=True)
@@ -88,13 +304,23 @@ class Book(db.Model):
     availability = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.Date, nullable=False, default=datetime.today())
     deleted = db.Column(db.Boolean(), default=False)
+    # Incremented by every UPDATE of the row, including bulk query updates
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0',
+                         onupdate=literal_column('revision + 1'))
+
+    @property
+    def fragment_key(self):
+        """Key of this book's encoded JSON in the fragment cache."""
+        return 'book', self.book_id, self.revision
 
     def create_book(self):
         db.session.add(self)
+        CatalogueVersion.bump()
         db.session.commit()
 
     def delete_book(self):
         db.session.delete(self)
+        CatalogueVersion.bump()
         db.session.commit()
 
     @staticmethod
@@ -103,16 +329,56 @@ class Book(db.Model):
 
     @staticmethod
     def get_all_books():
-        return Book.query.filter_by(deleted=False).order_by(desc(Book.created_at))
+        return Book.query.filter_by(deleted=False).order_by(desc(Book.created_at), desc(Book.book_id))
 
     @staticmethod
     def all_books():
         return Book.query.all()
 
+    @staticmethod
+    def title_taken(title):
+        return db.session.query(Book.query.filter_by(title=title).exists()).scalar()
+
     @staticmethod
     def get_book_available_for_borrowing():
         return Book.query.filter_by(availability=True).all()
 
+    @staticmethod
+    def search(terms):
+        """
+        Full text search over title, author and description, best matches first.
+        Uses a GIN indexed tsvector on Postgres, FTS5 on SQLite and falls
+        back to LIKE elsewhere.
+        :param terms:
+        :return:
+        """
+        words = terms.split()
+        query = Book.query.filter_by(deleted=False)
+        dialect = db.engine.dialect.name
+
+        if dialect == 'postgresql':
+            document = func.to_tsvector(literal_column("'english'"),
+                                        Book.title.op('||')(literal_column("' '")).op('||')(Book.author)
+                                        .op('||')(literal_column("' '")).op('||')(Book.description))
+            tsquery = func.plainto_tsquery(literal_column("'english'"), terms)
+            return query.filter(document.op('@@')(tsquery)) \
+                .order_by(desc(func.ts_rank(document, tsquery)), desc(Book.book_id))
+
+        if dialect == 'sqlite' and sqlite_has_fts5():
+            # Quote every word so user input is never read as FTS5 syntax
+            match = ' '.join('"{}"'.format(word.replace('"', '""')) for word in words)
+            fts = db.table('books_fts', db.column('rowid'), db.column('rank'))
+            return query.join(fts, fts.c.rowid == Book.book_id) \
+                .filter(text('books_fts MATCH :match')).params(match=match) \
+                .order_by(fts.c.rank, desc(Book.book_id))
+
+        for word in words:
+            pattern = '%{}%'.format(word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+            query = query.filter(or_(Book.title.ilike(pattern, escape='\\'),
+                                     Book.author.ilike(pattern, escape='\\'),
+                                     Book.description.ilike(pattern, escape='\\')))
+        return query.order_by(desc(Book.created_at), desc(Book.book_id))
+
     def __repr__(self):
         return '<Book: {}>'.format(self.book_id)
 
@@ -128,12 +394,70 @@ class Book(db.Model):
         }
 
 
+def sqlite_has_fts5():
+    """
+    Whether the sqlite3 library Python is linked against has FTS5
+    :return:
+    """
+    if not hasattr(sqlite_has_fts5, 'available'):
+        options = [row[0] for row in sqlite3.connect(':memory:').execute('PRAGMA compile_options')]
+        sqlite_has_fts5.available = 'ENABLE_FTS5' in options
+    return sqlite_has_fts5.available
+
+
+def _sqlite_fts5(ddl, target, bind, **kw):
+    return bind.dialect.name == 'sqlite' and sqlite_has_fts5()
+
+
+# Search index kept in step with the books table by triggers on SQLite
+BOOKS_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+    "title, author, description, content='books', content_rowid='book_id')",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN "
+    "INSERT INTO books_fts(rowid, title, author, description) "
+    "VALUES (new.book_id, new.title, new.author, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN "
+    "INSERT INTO books_fts(books_fts, rowid, title, author, description) "
+    "VALUES ('delete', old.book_id, old.title, old.author, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author, description ON books BEGIN "
+    "INSERT INTO books_fts(books_fts, rowid, title, author, description) "
+    "VALUES ('delete', old.book_id, old.title, old.author, old.description); "
+    "INSERT INTO books_fts(rowid, title, author, description) "
+    "VALUES (new.book_id, new.title, new.author, new.description); END",
+]
+
+BOOKS_SEARCH_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_books_search ON books USING gin "
+    "(to_tsvector('english', title || ' ' || author || ' ' || description))"
+)
+
+for statement in BOOKS_FTS_DDL:
+    event.listen(Book.__table__, 'after_create', DDL(statement).execute_if(callable_=_sqlite_fts5))
+event.listen(Book.__table__, 'before_drop',
+             DDL('DROP TABLE IF EXISTS books_fts').execute_if(callable_=_sqlite_fts5))
+event.listen(Book.__table__, 'after_create', DDL(BOOKS_SEARCH_INDEX_DDL).execute_if(dialect='postgresql'))
+
+
+class ConcurrentLoanError(Exception):
+    """
+    Raised when books change hands while a bulk borrow or return is running
+    """
+
+
 class BorrowingHistory(db.Model):
     """
     Class contains the borrowing history
     """
 
     __tablename__ = 'borrowed_books'
+    __table_args__ = (
+        db.Index('ix_borrowed_books_user_id_returned', 'user_id', 'returned'),
+        db.Index('ix_borrowed_books_book_id_returned', 'book_id', 'returned'),
+        db.Index('ix_borrowed_books_returned_due_date', 'returned', 'due_date'),
+    )
+
+    cursor_columns = ('id',)
+    cursor_descending = False
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     book_id = db.Column(db.Integer, db.ForeignKey('books.book_id'), nullable=False, default=1)
@@ -145,20 +469,133 @@ class BorrowingHistory(db.Model):
     due_date = db.Column(db.Date, nullable=False, default=datetime.today())
     returned = db.Column(db.Boolean, default=False)
     returned_date = db.Column(db.DateTime, default=datetime.today())
+    overdue = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+
+    @property
+    def fragment_key(self):
+        """Key of this record's encoded JSON, open loans also change daily as fines accrue."""
+        return 'history', self.id, self.returned, self.overdue, None if self.returned else date.today()
 
     @staticmethod
-    def user_borrowing_history():
-        hist = BorrowingHistory.query.all()
-        return hist
+    def user_borrowing_history(user_id, returned=None):
+        query = BorrowingHistory.query.filter_by(user_id=user_id)
+        if returned is not None:
+            query = query.filter_by(returned=returned)
+        return query.order_by(BorrowingHistory.id)
 
     @staticmethod
-    def unreturned_books_by_user():
-        return BorrowingHistory.query.filter_by(returned=False).all()
+    def unreturned_books_by_user(user_id):
+        return BorrowingHistory.user_borrowing_history(user_id, returned=False)
 
     def borrow_book(self):
         db.session.add(self)
         db.session.commit()
 
+    @staticmethod
+    def borrow(book_id, user_id, due_date):
+        """
+        Borrow a book in a single transaction, a bulk borrow of one book
+        :param book_id:
+        :param user_id:
+        :param due_date:
+        :return: False when the book is missing or already borrowed
+        """
+        try:
+            return BorrowingHistory.borrow_many([book_id], user_id, due_date)[book_id] == 'borrowed'
+        except ConcurrentLoanError:
+            # Another borrower got the book first
+            return False
+
+    @staticmethod
+    def return_borrowed(book_id):
+        """
+        Return a book in a single transaction, a bulk return of one book
+        :param book_id:
+        :return: False when the book is missing or not borrowed
+        """
+        try:
+            return BorrowingHistory.return_many([book_id])[book_id] == 'returned'
+        except ConcurrentLoanError:
+            # Another request returned the book first
+            return False
+
+    @staticmethod
+    def _lock_books(book_ids):
+        """
+        Read the availability of several books, locking their rows where the
+        database supports SELECT ... FOR UPDATE
+        :param book_ids:
+        :return: a dict of book_id to availability for the books that exist
+        """
+        return dict(db.session.query(Book.book_id, Book.availability)
+                    .filter(Book.book_id.in_(book_ids)).with_for_update())
+
+    @staticmethod
+    def borrow_many(book_ids, user_id, due_date):
+        """
+        Borrow several books in a single transaction with set based queries
+        :param book_ids:
+        :param user_id:
+        :param due_date:
+        :return: a dict of book_id to 'borrowed', 'not_available' or 'not_found'
+        """
+        found = BorrowingHistory._lock_books(book_ids)
+        available = [book_id for book_id in book_ids if found.get(book_id) is True]
+
+        if available:
+            flipped = Book.query.filter(Book.book_id.in_(available), Book.availability.is_(True)) \
+                .update({'availability': False}, synchronize_session=False)
+            if flipped != len(available):
+                # Another borrower got in between the read and the update
+                db.session.rollback()
+                raise ConcurrentLoanError()
+
+            books = Book.__table__
+            loans = db.select([books.c.book_id,
+                               books.c.title,
+                               books.c.author,
+                               books.c.description,
+                               literal(user_id, db.Integer),
+                               literal(datetime.now(), db.Date),
+                               literal(due_date, db.Date),
+                               literal(False, db.Boolean),
+                               literal(None, db.DateTime)]).where(books.c.book_id.in_(available))
+            db.session.execute(BorrowingHistory.__table__.insert().from_select(
+                ['book_id', 'book_title', 'book_author', 'book_description', 'user_id',
+                 'date_borrowed', 'due_date', 'returned', 'returned_date'], loans))
+            CatalogueVersion.bump()
+        db.session.commit()
+
+        return {book_id: 'borrowed' if book_id in available else
+                ('not_found' if book_id not in found else 'not_available')
+                for book_id in book_ids}
+
+    @staticmethod
+    def return_many(book_ids):
+        """
+        Return several books in a single transaction with set based queries
+        :param book_ids:
+        :return: a dict of book_id to 'returned', 'not_borrowed' or 'not_found'
+        """
+        found = BorrowingHistory._lock_books(book_ids)
+        borrowed = [book_id for book_id in book_ids if book_id in found and found[book_id] is not True]
+
+        if borrowed:
+            flipped = Book.query.filter(Book.book_id.in_(borrowed), Book.availability.isnot(True)) \
+                .update({'availability': True}, synchronize_session=False)
+            if flipped != len(borrowed):
+                db.session.rollback()
+                raise ConcurrentLoanError()
+
+            BorrowingHistory.query.filter(BorrowingHistory.book_id.in_(borrowed)).filter_by(returned=False) \
+                .update({'returned': True, 'returned_date': datetime.now()}, synchronize_session=False)
+            CatalogueVersion.bump()
+        db.session.commit()
+
+        return {book_id: 'returned' if book_id in borrowed else
+                ('not_found' if book_id not in found else 'not_borrowed')
+                for book_id in book_ids}
+
     def __repr__(self):
         return '<Borrowing History: {}>'.format(self.book_id)
 
@@ -166,22 +603,116 @@ class BorrowingHistory(db.Model):
     def get_book(book_id):
         return BorrowingHistory.query.filter_by(book_id=book_id, returned=False).first()
 
+    @staticmethod
+    def overdue_loans(today):
+        """
+        Open loans that were due before today, a range scan of the (returned, due_date) index
+        :param today:
+        :return:
+        """
+        return BorrowingHistory.query.filter_by(returned=False) \
+            .filter(BorrowingHistory.due_date < today) \
+            .order_by(BorrowingHistory.due_date, BorrowingHistory.id)
+
+    def days_overdue(self, today):
+        """
+        Days the loan is, or was when returned, past its due date
+        :param today:
+        :return:
+        """
+        end = self.returned_date.date() if self.returned and self.returned_date else today
+        return max(0, (end - self.due_date).days)
+
     @property
     def serialize(self):
-        """Serialize."""
+        """Serialize, with the fine accrued so far."""
+        days_overdue = self.days_overdue(date.today())
         return {
             'book_id': self.book_id,
             'book_title': self.book_title,
             'book_author': self.book_author,
             'book_description': self.book_description,
             'user_id': self.user_id,
-            'date_borrowed': self.date_borrowed,
-            'due_date': self.due_date,
+            'date_borrowed': http_date(self.date_borrowed),
+            'due_date': http_date(self.due_date),
             'returned': self.returned,
-            'returned_date': self.returned_date
+            'returned_date': http_date(self.returned_date),
+            'overdue': self.overdue,
+            'days_overdue': days_overdue,
+            'fine': days_overdue * current_app.config['OVERDUE_FINE_PER_DAY']
         }
 
 
+class CatalogueVersion(db.Model):
+    """
+    Single row stamp bumped by every write to the catalogue.
+    Catalogue reads use it as their ETag and Last-Modified.
+    """
+
+    __tablename__ = 'catalogue_version'
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @staticmethod
+    def current():
+        """
+        Return the current (version, updated_at) of the catalogue
+        :return:
+        """
+        row = db.session.query(CatalogueVersion.version, CatalogueVersion.updated_at).filter_by(id=1).first()
+        return row if row is not None else (0, None)
+
+    @staticmethod
+    def bump():
+        """
+        Mark the catalogue as changed as part of the caller's transaction
+        :return:
+        """
+        CatalogueVersion.query.filter_by(id=1).update(
+            {'version': CatalogueVersion.version + 1, 'updated_at': datetime.utcnow()},
+            synchronize_session=False)
+        # Lets caches of catalogue reads drop their entries once this commits
+        db.session.info['catalogue_changed'] = True
+
+
+event.listen(CatalogueVersion.__table__, 'after_create',
+             DDL("INSERT INTO catalogue_version (id, version, updated_at) VALUES (1, 0, CURRENT_TIMESTAMP)"))
+
+
+class Watermark(db.Model):
+    """
+    How far an incremental process has got, by name
+    """
+
+    __tablename__ = 'watermarks'
+
+    name = db.Column(db.String(60), primary_key=True)
+    value = db.Column(db.Date, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+
+class Job(db.Model):
+    """
+    Background job queued for, or processed by, the worker
+    """
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(60), nullable=False)
+    payload = db.Column(db.Text(), nullable=False, default='{}')
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text())
+    finished_at = db.Column(db.DateTime)
+
+
 class ActiveTokens(db.Model):
     """
     Class containing the active tokens
@@ -221,7 +752,7 @@ class RevokedTokens(db.Model):
     __tablename__ = 'revoked_tokens'
 
     id = db.Column(db.Integer, primary_key=True)
-    time_revoked = db.Column(db.DateTime, default=datetime.today())
+    time_revoked = db.Column(db.DateTime, default=datetime.now, index=True)
     jti = db.Column(db.String(200), unique=True)
 
     def revoke_token(self):
@@ -246,35 +777,156 @@ def group(list_obj, group_len):
     for i in range(0, len(list_obj), group_len):
         yield list_obj[i:i+group_len]
 
+# Largest page size clients may ask for
+MAX_PAGE_LIMIT = 100
+
+
+def page_limit(limit_param):
+    """
+    Parse a page size, raising ValueError unless it is a positive number.
+    Larger sizes than MAX_PAGE_LIMIT are served MAX_PAGE_LIMIT rows.
+    :param limit_param:
+    :return:
+    """
+    try:
+        limit = int(limit_param)
+    except (TypeError, ValueError):
+        limit = None
+    if limit is None or limit < 1:
+        raise ValueError('Limit must be a positive number')
+    return min(limit, MAX_PAGE_LIMIT)
+
+
+def page_number(page_param):
+    """
+    Parse a page number, raising ValueError unless it is at least 1
+    :param page_param:
+    :return:
+    """
+    try:
+        page = int(page_param)
+    except (TypeError, ValueError):
+        page = None
+    if page is None or page < 1:
+        raise ValueError('Page must be a positive number')
+    return page
+
+
 def get_paginated(limit_param, results, url, page_param):
     """
-    Return paginated results
+    Return paginated results.
+    When results is a query the page is fetched with LIMIT/OFFSET and the
+    total comes from a COUNT, so only the requested rows are loaded.
     :param limit_param:
     :param results:
     :param url:
     :param page_param:
-    :return:
+    :return: False when the page is past the last one
     """
 
-    page = int(page_param)
-    limit = int(limit_param)
-    page_count = ceil(len(results) / limit)
+    page = page_number(page_param)
+    limit = page_limit(limit_param)
+    if isinstance(results, Query):
+        total = results.order_by(None).count()
+    else:
+        total = len(results)
+    page_count = ceil(total / limit)
+    separator = '&' if '?' in url else '?'
     paginated = {}
     if page == 1:
         paginated['previous'] = 'None'
     else:
-        paginated['previous'] = url + '?page={}&limit={}'.format(page - 1, limit)
+        paginated['previous'] = url + separator + 'page={}&limit={}'.format(page - 1, limit)
 
     if page < page_count:
-        paginated['next'] = url + '?page={}&limit={}'.format(page + 1, limit)
-    elif page > page_count:
+        paginated['next'] = url + separator + 'page={}&limit={}'.format(page + 1, limit)
+    elif page > max(page_count, 1):
         return False
     else:
         paginated['next'] = 'None'
 
-    for i, value in enumerate(group(results, limit)):
-        if i == (page - 1):
-            paginated['results'] = value
-            break
+    paginated['results'] = results[(page - 1) * limit:page * limit]
+
+    return paginated
+
+
+def encode_cursor(values):
+    """
+    Encode the ordering values of a row into an opaque cursor
+    :param values:
+    :return:
+    """
+    values = [value.isoformat() if isinstance(value, date) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, columns):
+    """
+    Decode a cursor back into values for the given columns.
+    Raises ValueError when the cursor is malformed.
+    :param cursor:
+    :param columns:
+    :return:
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid cursor')
+
+    decoded = []
+    for column, value in zip(columns, values):
+        python_type = column.type.python_type
+        try:
+            if python_type is datetime:
+                value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+            elif python_type is date:
+                value = datetime.strptime(value, '%Y-%m-%d').date()
+            elif python_type is int:
+                value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor')
+        decoded.append(value)
+    return decoded
+
+
+def get_cursor_paginated(limit_param, query, url, cursor_param):
+    """
+    Return results paginated with a keyset cursor.
+    Rows are ordered by the model's cursor_columns and each page seeks past
+    the last row of the previous one, so deep pages cost the same as the first.
+    :param limit_param:
+    :param query:
+    :param url:
+    :param cursor_param:
+    :return:
+    """
+    limit = page_limit(limit_param)
+    model = query.column_descriptions[0]['entity']
+    columns = [getattr(model, name) for name in model.cursor_columns]
+    descending = model.cursor_descending
+
+    if cursor_param:
+        values = decode_cursor(cursor_param, columns)
+        seek = []
+        for i, column in enumerate(columns):
+            equal = [columns[j] == values[j] for j in range(i)]
+            past = column < values[i] if descending else column > values[i]
+            seek.append(and_(*(equal + [past])))
+        query = query.filter(or_(*seek))
+
+    ordering = [desc(column) if descending else column for column in columns]
+    rows = query.order_by(None).order_by(*ordering).limit(limit + 1).all()
+
+    paginated = {'previous': 'None', 'results': rows[:limit]}
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        cursor = encode_cursor([getattr(last, name) for name in model.cursor_columns])
+        separator = '&' if '?' in url else '?'
+        paginated['next'] = url + separator + 'cursor={}&limit={}'.format(cursor, limit)
+    else:
+        paginated['next'] = 'None'
 
-    return paginated
\ No newline at end of file
+    return paginated
@@ -0,0 +1,41 @@
+"""
+Incremental flagging of overdue loans.
+
+The 'overdue' watermark is the day up to which open loans have been
+checked. Each run only scans loans that fell due since then, through the
+(returned, due_date) index, so a daily run costs the same however long
+the borrowing history grows.
+"""
+from datetime import date
+
+from .models import BorrowingHistory, Watermark, db
+
+WATERMARK = 'overdue'
+
+
+def process_overdue(today=None, full=False):
+    """
+    Flag the open loans that fell due since the last run
+    :param today: the first day loans are not yet overdue, today by default
+    :param full: ignore the watermark and check every open loan
+    :return: the number of loans flagged
+    """
+    today = today or date.today()
+    mark = Watermark.query.get(WATERMARK)
+    since = None if full or mark is None else mark.value
+    if since is not None and since >= today:
+        return 0
+
+    query = BorrowingHistory.query.filter_by(returned=False) \
+        .filter(BorrowingHistory.due_date < today)
+    if since is not None:
+        query = query.filter(BorrowingHistory.due_date >= since)
+    flagged = query.filter_by(overdue=False) \
+        .update({'overdue': True}, synchronize_session=False)
+
+    if mark is None:
+        db.session.add(Watermark(name=WATERMARK, value=today))
+    else:
+        mark.value = max(mark.value, today)
+    db.session.commit()
+    return flagged
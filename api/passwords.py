@@ -0,0 +1,190 @@
+"""
+Password hashing.
+
+PASSWORD_HASH_METHOD picks the algorithm for new hashes: 'pbkdf2:sha256'
+(werkzeug, PASSWORD_HASH_ITERATIONS rounds, by default the 50000 of the
+pinned werkzeug) or 'bcrypt' (BCRYPT_LOG_ROUNDS cost, needs the bcrypt
+package). Hashes made with other parameters still verify and are
+replaced on the user's next login.
+
+With PASSWORD_HASH_WORKERS above 0 hashing runs in a thread or process
+pool (PASSWORD_HASH_EXECUTOR) of that size. At most PASSWORD_HASH_QUEUE
+more hashes may wait for it; a request finding the queue full waits up
+to PASSWORD_HASH_TIMEOUT seconds for a place and then raises HashingBusy.
+The request blocks its thread while it waits, so the pool only serves
+several requests at once with threaded (gthread) or gevent workers; a
+sync worker handles one request at a time either way.
+"""
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from .models import db
+
+try:
+    import bcrypt
+except ImportError:  # pragma: no cover
+    bcrypt = None
+
+METHODS = ('pbkdf2:sha256', 'bcrypt')
+EXECUTORS = ('thread', 'process')
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool and its queue are full."""
+
+
+def _hash(password, method, cost):
+    if method == 'bcrypt':
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(cost)).decode('ascii')
+    return generate_password_hash(password, method='{}:{}'.format(method, cost))
+
+
+def _verify(hashed, password):
+    if hashed.startswith('$2'):
+        if bcrypt is None:
+            raise RuntimeError('A bcrypt password hash was found but bcrypt is not installed')
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('ascii'))
+    return check_password_hash(hashed, password)
+
+
+def _parameters(hashed):
+    """
+    Return the (method, cost) a hash was made with
+    :param hashed:
+    :return:
+    """
+    if hashed.startswith('$2'):
+        return 'bcrypt', int(hashed.split('$')[2])
+    method = hashed.split('$', 1)[0]
+    if method.startswith('pbkdf2:'):
+        parts = method.split(':')
+        # werkzeug writes the iteration count after the digest
+        return ':'.join(parts[:2]), int(parts[2]) if len(parts) > 2 else None
+    return method, None
+
+
+class _HasherState(object):
+    """
+    Hashing parameters and the lazily started pool of one app.
+    """
+
+    def __init__(self, config):
+        self.method = config['PASSWORD_HASH_METHOD']
+        if self.method == 'bcrypt':
+            self.cost = config['BCRYPT_LOG_ROUNDS']
+        else:
+            self.cost = config['PASSWORD_HASH_ITERATIONS']
+        self.workers = config['PASSWORD_HASH_WORKERS']
+        self.executor_type = config['PASSWORD_HASH_EXECUTOR']
+        self.timeout = config['PASSWORD_HASH_TIMEOUT']
+        self.slots = threading.BoundedSemaphore(self.workers + config['PASSWORD_HASH_QUEUE']) \
+            if self.workers else None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _executor(self):
+        # Started on first use so that process pools are forked by the
+        # serving worker rather than by the parent that imported the app
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    pool = ProcessPoolExecutor if self.executor_type == 'process' else ThreadPoolExecutor
+                    self.executor = pool(max_workers=self.workers)
+        return self.executor
+
+    def run(self, func, *args):
+        """
+        Run a hashing function inline or in the pool
+        :param func:
+        :param args:
+        :return:
+        """
+        if self.slots is None:
+            return func(*args)
+        if not self.slots.acquire(timeout=self.timeout):
+            raise HashingBusy()
+        try:
+            return self._executor().submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+
+class PasswordHasher(object):
+    """
+    Configures password hashing for an app.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+        # werkzeug 0.14's own default, so existing hashes are not upgraded
+        app.config.setdefault('PASSWORD_HASH_ITERATIONS', 50000)
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 0)
+        app.config.setdefault('PASSWORD_HASH_EXECUTOR', 'thread')
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 16)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 5)
+
+        if app.config['PASSWORD_HASH_METHOD'] not in METHODS:
+            raise ValueError('PASSWORD_HASH_METHOD must be one of: {}'.format(', '.join(METHODS)))
+        if app.config['PASSWORD_HASH_METHOD'] == 'bcrypt' and bcrypt is None:
+            raise RuntimeError('PASSWORD_HASH_METHOD is bcrypt but bcrypt is not installed')
+        if app.config['PASSWORD_HASH_EXECUTOR'] not in EXECUTORS:
+            raise ValueError('PASSWORD_HASH_EXECUTOR must be one of: {}'.format(', '.join(EXECUTORS)))
+        app.extensions['password_hasher'] = _HasherState(app.config)
+
+
+def _state():
+    return current_app.extensions['password_hasher']
+
+
+def hash_password(password):
+    """
+    Hash a password with the configured method and cost
+    :param password:
+    :return:
+    """
+    state = _state()
+    return state.run(_hash, password, state.method, state.cost)
+
+
+def verify_password(hashed, password):
+    """
+    Check a password against a hash made with any supported parameters
+    :param hashed:
+    :param password:
+    :return:
+    """
+    return _state().run(_verify, hashed, password)
+
+
+def needs_rehash(hashed):
+    """
+    Check whether a hash was made with other than the configured parameters
+    :param hashed:
+    :return:
+    """
+    state = _state()
+    return _parameters(hashed) != (state.method, state.cost)
+
+
+def check_user_password(user, password):
+    """
+    Verify a user's password, upgrading the stored hash to the configured
+    parameters when it matches and was made with different ones
+    :param user:
+    :param password:
+    :return:
+    """
+    if not verify_password(user.user_password, password):
+        return False
+    if needs_rehash(user.user_password):
+        user.user_password = hash_password(password)
+        db.session.commit()
+    return True
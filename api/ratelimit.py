@@ -0,0 +1,216 @@
+"""
+Token bucket rate limiting of sensitive endpoints.
+
+RATE_LIMITS maps an endpoint name to the buckets a request to it draws
+from, e.g. {'user.login_user': {'ip': '10/minute', 'email': '5/minute'}}.
+A limit of 'N/period' allows bursts of N requests and refills N tokens
+per period. 'ip' buckets are keyed by the client address and 'email'
+buckets by the email in the request body.
+
+RATE_LIMIT_STORAGE is 'memory' for buckets private to each worker, or
+'sqlite' to share them between the workers of a host through the file
+RATE_LIMIT_SQLITE_PATH, which must be set and sit in a directory private
+to the app's user.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .cache import private_directory
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400
+}
+
+STORAGES = ('memory', 'sqlite')
+
+SCOPES = ('ip', 'email')
+
+
+def parse_limit(limit):
+    """
+    Parse 'N/period' into the bucket capacity and its refill rate per second
+    :param limit:
+    :return:
+    """
+    count, _, period = limit.partition('/')
+    period = period.strip().rstrip('s')
+    if period not in PERIODS or not count.strip().isdigit():
+        raise ValueError('Rate limit {!r} must look like 10/minute'.format(limit))
+    capacity = int(count)
+    return capacity, capacity / PERIODS[period]
+
+
+def _refill(tokens, stamp, capacity, rate, now):
+    return min(capacity, tokens + (now - stamp) * rate)
+
+
+class MemoryStore(object):
+    """
+    Buckets held by this worker. Only keys that were limited recently are
+    kept, as (tokens, timestamp) pairs, and the least recently used ones
+    are dropped beyond max_keys; a dropped bucket comes back full.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, rate, now=None):
+        """
+        Take a token from the bucket under key
+        :param key:
+        :param capacity:
+        :param rate:
+        :param now:
+        :return: 0 when allowed, otherwise the seconds until a token is available
+        """
+        return self.consume_all([(key, capacity, rate)], now)
+
+    def consume_all(self, buckets, now=None):
+        """
+        Take a token from each bucket only when every one of them has a token
+        :param buckets: (key, capacity, rate) tuples
+        :param now:
+        :return: 0 when allowed, otherwise the seconds until all buckets have a token
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            refilled = []
+            wait = 0
+            for key, capacity, rate in buckets:
+                tokens, stamp = self._buckets.get(key, (capacity, now))
+                tokens = _refill(tokens, stamp, capacity, rate, now)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                refilled.append((key, tokens))
+
+            for key, tokens in refilled:
+                self._buckets[key] = (tokens if wait else tokens - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteStore(object):
+    """
+    Buckets in a SQLite file shared by every worker of the host.
+    Each take is one short write transaction.
+    """
+
+    # Rows of buckets that have refilled are deleted every PRUNE_EVERY takes
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        # Other local users must not be able to create or replace the file
+        private_directory(os.path.dirname(os.path.abspath(path)))
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS buckets '
+                           '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, stamp REAL NOT NULL, '
+                           'full_at REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_buckets_full_at ON buckets (full_at)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def consume(self, key, capacity, rate, now=None):
+        """
+        Take a token from the bucket under key
+        :param key:
+        :param capacity:
+        :param rate:
+        :param now:
+        :return: 0 when allowed, otherwise the seconds until a token is available
+        """
+        return self.consume_all([(key, capacity, rate)], now)
+
+    def consume_all(self, buckets, now=None):
+        """
+        Take a token from each bucket only when every one of them has a token
+        :param buckets: (key, capacity, rate) tuples
+        :param now:
+        :return: 0 when allowed, otherwise the seconds until all buckets have a token
+        """
+        # Wall clock time, since the workers sharing the file have different monotonic clocks
+        now = time.time() if now is None else now
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            refilled = []
+            wait = 0
+            for key, capacity, rate in buckets:
+                row = connection.execute('SELECT tokens, stamp FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens = capacity if row is None else _refill(row[0], row[1], capacity, rate, now)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                refilled.append((key, capacity, rate, tokens))
+
+            for key, capacity, rate, tokens in refilled:
+                if not wait:
+                    tokens -= 1
+                connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, stamp, full_at) '
+                                   'VALUES (?, ?, ?, ?)', (key, tokens, now, now + (capacity - tokens) / rate))
+            self._takes += 1
+            if self._takes % self.PRUNE_EVERY == 0:
+                connection.execute('DELETE FROM buckets WHERE full_at < ?', (now,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter(object):
+    """
+    Holds the parsed limits and the bucket store of an app.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATE_LIMITS', {
+            'user.login_user': {'ip': '20/minute', 'email': '5/minute'},
+            'user.register_user': {'ip': '5/minute'}
+        })
+        app.config.setdefault('RATE_LIMIT_STORAGE', 'memory')
+        app.config.setdefault('RATE_LIMIT_MAX_KEYS', 100000)
+        app.config.setdefault('RATE_LIMIT_SQLITE_PATH', None)
+
+        storage = app.config['RATE_LIMIT_STORAGE']
+        if storage == 'memory':
+            store = MemoryStore(app.config['RATE_LIMIT_MAX_KEYS'])
+        elif storage == 'sqlite':
+            if not app.config['RATE_LIMIT_SQLITE_PATH']:
+                raise ValueError('RATE_LIMIT_SQLITE_PATH must be set for the sqlite rate limit storage')
+            store = SQLiteStore(app.config['RATE_LIMIT_SQLITE_PATH'])
+        else:
+            raise ValueError('RATE_LIMIT_STORAGE must be one of: {}'.format(', '.join(STORAGES)))
+
+        limits = {}
+        for endpoint, buckets in (app.config['RATE_LIMITS'] or {}).items():
+            for scope in buckets:
+                if scope not in SCOPES:
+                    raise ValueError('Rate limits of {} must be keyed by one of: {}'.format(
+                        endpoint, ', '.join(SCOPES)))
+            limits[endpoint] = [(scope, parse_limit(limit)) for scope, limit in sorted(buckets.items())]
+        app.extensions['rate_limiter'] = (limits, store)
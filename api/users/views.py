@@ -1,13 +1,20 @@
 import re
 
-from flask import jsonify, request
+from flask import request
+from sqlalchemy.exc import IntegrityError
 from flask_jwt_extended import create_access_token, get_raw_jwt, get_jwt_identity, jwt_required
 
-from api.models import User, ActiveTokens, RevokedTokens, db, check_password_hash, generate_password_hash
+from api import revocation_cache
+from api.auth import get_current_user
+from api.decorators import rate_limited
+from api.encoders import jsonify
+from api.models import User, ActiveTokens, RevokedTokens, db
+from api.passwords import check_user_password, hash_password
 from . import user
 
 
 @user.route('/api/v2/auth/register', methods=['POST'])
+@rate_limited
 def register_user():
     """
     Registers a new user
@@ -30,9 +37,7 @@ def register_user():
     # elif is_admin is None:
     #     return jsonify({'message': 'User role not provided'}), 403
 
-    users = User.all_users()
-    users_username = [user for user in users if user.username == username]
-    if users_username:
+    if User.username_taken(username):
         return {"message": "This Username is already taken."}, 200
 
     if len(password) < 8:
@@ -49,26 +54,36 @@ def register_user():
     if valid_email is None:
         return jsonify({'message': 'Please enter a valid Email!'}), 400
 
-    users_email = [user for user in users if user.email == email]
-    if users_email:
+    if User.email_taken(email):
         return {"message": "This Email already exists."}, 400
 
-    hashed_password = generate_password_hash(password=password)
-
-    response = jsonify(User(username=username,
-                            user_password=hashed_password,
-                            email=email,
-                            is_admin=is_admin).create_user())
+    hashed_password = hash_password(password)
+
+    try:
+        User(username=username,
+             user_password=hashed_password,
+             email=email,
+             is_admin=is_admin).create_user()
+    except IntegrityError:
+        # Lost a race with a concurrent registration, the unique constraints decide
+        db.session.rollback()
+        if User.username_taken(username):
+            return {"message": "This Username is already taken."}, 200
+        return {"message": "This Email already exists."}, 400
 
     return {"message": "User registration successful."}, 201
 
 
 @user.route('/api/v2/auth/login', methods=['POST'])
+@rate_limited
 def login_user():
     """
     Function to login user
     :return:
     """
+    if not request.is_json:
+        return {"message": "Login credentials must be sent as JSON"}, 400
+
     user_data = request.get_json()
 
     if not user_data:
@@ -90,7 +105,7 @@ def login_user():
     else:
         isAdmin = False
 
-    if not check_password_hash(user.user_password, user_data["password"]):
+    if not check_user_password(user, user_data["password"]):
         return jsonify ({'message': "Wrong Email or Password"}), 400
 
     access_token = create_access_token(identity=user_data["email"])
@@ -131,9 +146,10 @@ def logout_user():
 
     jti = get_raw_jwt()['jti']
 
-    if logged_in_user == user_email and not RevokedTokens.is_jti_blacklisted(jti):
+    if logged_in_user == user_email and not revocation_cache.is_revoked(jti):
         revoke_token = RevokedTokens(jti=jti)
         revoke_token.revoke_token()
+        revocation_cache.add(jti)
         # ActiveTokens.find_user_with_token(user_email).delete_active_token()
         response = jsonify({'Success': 'User successfully logged out.'})
 
@@ -163,14 +179,12 @@ def user_password_reset():
     if len(userdata['password']) < 8:
         return jsonify({'message': 'Password should be at least 8 characters long.'}), 400
 
-    present_user = User.get_user_by_email(userdata["email"])
-    logged_in_user = User.get_user_by_email(get_jwt_identity())
-
-    if present_user != logged_in_user:
+    if userdata["email"] != get_jwt_identity():
         return jsonify({'message': "Wrong email. "
                                    "Please use the email you logged in with."}), 400
     else:
-        new_password = generate_password_hash(password=userdata["password"])
+        present_user = get_current_user()
+        new_password = hash_password(userdata["password"])
 
         if present_user.user_password == userdata["password"]:
             return jsonify({'message': "No changes detected in the password"}), 400
@@ -178,6 +192,7 @@ def user_password_reset():
         jti = get_raw_jwt()['jti']
         revoke_token = RevokedTokens(jti=jti)
         revoke_token.revoke_token()
+        revocation_cache.add(jti)
         # ActiveTokens.find_user_with_token(userdata["email"]).delete_active_token()
 
         present_user.user_password = new_password
@@ -0,0 +1,85 @@
+"""
+Compare the stdlib and orjson response encoders on a large catalogue payload.
+
+Usage: python benchmarks/bench_encoders.py [--books 10000] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.encoders import http_date, orjson, orjson_dumps, stdlib_dumps  # noqa: E402
+
+
+def make_payloads(books):
+    """
+    Build a listing of books and a borrowing history of the same size,
+    the history with date objects and as served with formatted dates
+    :param books:
+    :return:
+    """
+    today = date.today()
+    catalogue = {
+        'next': 'None',
+        'previous': 'None',
+        'results': [{
+            'book_id': book_id,
+            'title': 'Book number {}'.format(book_id),
+            'author': 'Author {}'.format(book_id % 300),
+            'description': 'A description of book {} that is a sentence or two long.'.format(book_id) * 2,
+            'availability': book_id % 3 != 0
+        } for book_id in range(1, books + 1)]
+    }
+    history = {
+        'next': 'None',
+        'previous': 'None',
+        'results': [{
+            'book_id': book_id,
+            'book_title': 'Book number {}'.format(book_id),
+            'user_id': book_id % 50,
+            'date_borrowed': today,
+            'due_date': today + timedelta(days=6),
+            'returned': False,
+            'returned_date': datetime.now()
+        } for book_id in range(1, books + 1)]
+    }
+    # BorrowingHistory.serialize formats its dates before they reach the encoder
+    formatted = dict(history, results=[dict(loan, date_borrowed=http_date(loan['date_borrowed']),
+                                            due_date=http_date(loan['due_date']),
+                                            returned_date=http_date(loan['returned_date']))
+                                       for loan in history['results']])
+    return [('books', catalogue), ('history', history), ('served', formatted)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    encoders = [('stdlib', stdlib_dumps)]
+    if orjson is not None:
+        encoders.append(('orjson', orjson_dumps))
+    else:
+        print('orjson is not installed, only the stdlib encoder is measured')
+
+    for label, payload in make_payloads(args.books):
+        outputs = {}
+        timings = {}
+        for name, encode in encoders:
+            outputs[name] = json.loads(encode(payload).decode('utf-8'))
+            timings[name] = min(timeit.repeat(lambda: encode(payload), number=1, repeat=args.repeat))
+            print('{:<8} {:<7} {:8.2f} ms  {:8d} bytes'.format(label, name, timings[name] * 1000,
+                                                                len(encode(payload))))
+
+        if 'orjson' in timings:
+            assert outputs['orjson'] == outputs['stdlib'], 'encoders disagree'
+            print('{:<8} orjson is {:.1f}x faster'.format(label, timings['stdlib'] / timings['orjson']))
+
+
+if __name__ == '__main__':
+    main()
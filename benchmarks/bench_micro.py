@@ -0,0 +1,373 @@
+"""
+Micro-benchmarks of the model helpers and decorators on the request path.
+
+Usage: python benchmarks/bench_micro.py [-k filter] [--rounds 7] [--min-time 0.05]
+           [--save NAME] [--compare NAME] [--max-regression 25]
+
+Every benchmark is a function taking a `benchmark` callable, which works
+like the pytest-benchmark fixture: benchmark(func, *args) calibrates how
+many calls fill --min-time seconds, times --rounds such batches and keeps
+the statistics. The functions run against an in-memory SQLite database
+seeded with a catalogue, a borrowing history and revoked tokens, using
+the production password hashing cost. Where a helper replaced an older
+path, such as the revocation cache in front of revoked_tokens, both are
+measured so their times can be compared side by side.
+
+--save stores the results as benchmarks/baselines/NAME.json. --compare
+prints the change in median time of every benchmark against a stored
+baseline and exits with status 1 when one got slower by more than
+--max-regression percent, so a change can show its gain and regressions
+are caught. Baselines only compare within the same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, ROOT)
+
+from flask_jwt_extended import create_access_token, jwt_required  # noqa: E402
+from werkzeug.security import check_password_hash  # noqa: E402
+
+from api import create_app, revocation_cache  # noqa: E402
+from api.cache import encode_fragments  # noqa: E402
+from api.decorators import admin_user, allow_pagination  # noqa: E402
+from api.encoders import stdlib_dumps  # noqa: E402
+from api.models import (Book, BorrowingHistory, RevokedTokens, User, db, get_cursor_paginated,  # noqa: E402
+                        get_paginated, group)
+from api.passwords import hash_password, verify_password  # noqa: E402
+
+BASELINES = os.path.join(BENCHMARKS, 'baselines')
+
+PASSWORD = 'r7eee#eooM'
+
+CATALOGUE_SIZE = 5000
+HISTORY_SIZE = 2000
+REVOKED_TOKENS = 1000
+
+# name: function, in the order they run
+REGISTRY = {}
+
+
+def bench(name):
+    """
+    Decorator registering a benchmark under name
+    :param name:
+    :return:
+    """
+    def register(func):
+        REGISTRY[name] = func
+        return func
+    return register
+
+
+class Benchmark(object):
+    """
+    Times one function, like the benchmark fixture of pytest-benchmark.
+    """
+
+    def __init__(self, rounds, min_time):
+        self.rounds = rounds
+        self.min_time = min_time
+        self.stats = None
+
+    def _batch(self, func, args, kwargs, number):
+        started = time.perf_counter()
+        for _ in range(number):
+            func(*args, **kwargs)
+        return time.perf_counter() - started
+
+    def __call__(self, func, *args, **kwargs):
+        # Warm up caches and calibrate the calls per round
+        number = 1
+        elapsed = self._batch(func, args, kwargs, number)
+        while elapsed < self.min_time:
+            number = max(number * 2, int(number * self.min_time / max(elapsed, 1e-9) * 1.2))
+            elapsed = self._batch(func, args, kwargs, number)
+
+        times = [self._batch(func, args, kwargs, number) / number for _ in range(self.rounds)]
+        self.stats = {
+            'min': min(times),
+            'max': max(times),
+            'mean': statistics.mean(times),
+            'median': statistics.median(times),
+            'stddev': statistics.stdev(times) if len(times) > 1 else 0.0,
+            'rounds': self.rounds,
+            'iterations': number,
+            'ops': 1 / statistics.mean(times)
+        }
+        return func(*args, **kwargs)
+
+
+class Environment(object):
+    """
+    The app, its seeded database and the values the benchmarks need.
+    """
+
+    def __init__(self):
+        self.app = create_app('production')
+        self.app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', SQLALCHEMY_REPLICA_URIS=[])
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        self.password_hash = hash_password(PASSWORD)
+        admin = User('benchadmin', self.password_hash, 'benchadmin@example.com', True)
+        db.session.add(admin)
+        db.session.execute(Book.__table__.insert(), [{
+            'title': 'Book number {}'.format(book_id),
+            'author': 'Author {}'.format(book_id % 300),
+            'description': 'A description of book {} that is a sentence or two long.'.format(book_id),
+            'availability': True,
+            'created_at': datetime.today(),
+            'deleted': False
+        } for book_id in range(1, CATALOGUE_SIZE + 1)])
+        db.session.commit()
+
+        now = datetime.now()
+        db.session.execute(BorrowingHistory.__table__.insert(), [{
+            'book_id': loan % CATALOGUE_SIZE + 1,
+            'book_title': 'Book number {}'.format(loan % CATALOGUE_SIZE + 1),
+            'book_author': 'Author {}'.format(loan % 300),
+            'book_description': 'A description of the book.',
+            'user_id': admin.id,
+            'date_borrowed': (now - timedelta(days=loan % 30 + 7)).date(),
+            'due_date': (now - timedelta(days=loan % 30 + 1)).date(),
+            'returned': loan % 2 == 0,
+            'returned_date': now,
+            'overdue': False
+        } for loan in range(HISTORY_SIZE)])
+        db.session.execute(RevokedTokens.__table__.insert(), [
+            {'jti': 'revoked-{}'.format(index), 'time_revoked': now} for index in range(REVOKED_TOKENS)])
+        db.session.commit()
+
+        self.book = Book.query.get(CATALOGUE_SIZE // 2)
+        self.page = Book.query.order_by(Book.book_id).limit(20).all()
+        self.loan = BorrowingHistory.query.get(HISTORY_SIZE // 2)
+        self.admin_token = create_access_token(identity=admin.email)
+
+    def close(self):
+        db.session.remove()
+        self.context.pop()
+
+
+def _register_group(size):
+    @bench('group[{}]'.format(size))
+    def bench_group(benchmark, env):
+        items = list(range(size))
+        benchmark(lambda: list(group(items, 20)))
+
+
+def _register_paginated_list(size):
+    @bench('get_paginated[list-{}]'.format(size))
+    def bench_get_paginated_list(benchmark, env):
+        items = list(range(size))
+        benchmark(get_paginated, 20, items, 'http://localhost/api/v2/books', 3)
+
+
+for _size in (100, 1000, 10000):
+    _register_group(_size)
+    _register_paginated_list(_size)
+
+
+@bench('get_paginated[query-{}]'.format(CATALOGUE_SIZE))
+def bench_get_paginated_query(benchmark, env):
+    benchmark(lambda: get_paginated(20, Book.query.order_by(Book.book_id), 'http://localhost/api/v2/books', 3))
+
+
+@bench('get_cursor_paginated[query-{}]'.format(CATALOGUE_SIZE))
+def bench_get_cursor_paginated_query(benchmark, env):
+    benchmark(lambda: get_cursor_paginated(20, Book.query, 'http://localhost/api/v2/books', ''))
+
+
+@bench('allow_pagination[page]')
+def bench_allow_pagination(benchmark, env):
+    view = allow_pagination(lambda: Book.query.order_by(Book.book_id))
+    with env.app.test_request_context('/api/v2/books?page=3&limit=20'):
+        benchmark(view)
+
+
+@bench('allow_pagination[cursor]')
+def bench_allow_pagination_cursor(benchmark, env):
+    view = allow_pagination(lambda: Book.query.order_by(Book.book_id))
+    with env.app.test_request_context('/api/v2/books?cursor=&limit=20'):
+        benchmark(view)
+
+
+def _admin_request(env):
+    # A fresh request per call, the user is loaded at most once per request
+    view = jwt_required(admin_user(lambda: 'ok'))
+    headers = {'Authorization': 'Bearer {}'.format(env.admin_token)}
+
+    def request():
+        with env.app.test_request_context('/api/v2/books', headers=headers):
+            return view()
+    return request
+
+
+@bench('admin_user')
+def bench_admin_user(benchmark, env):
+    benchmark(_admin_request(env))
+
+
+@bench('admin_user[no identity cache]')
+def bench_admin_user_uncached(benchmark, env):
+    identity_cache = env.app.extensions['identity_cache']
+    env.app.extensions['identity_cache'] = None
+    try:
+        benchmark(_admin_request(env))
+    finally:
+        env.app.extensions['identity_cache'] = identity_cache
+
+
+@bench('Book.serialize')
+def bench_book_serialize(benchmark, env):
+    benchmark(lambda: env.book.serialize)
+
+
+@bench('BorrowingHistory.serialize')
+def bench_history_serialize(benchmark, env):
+    benchmark(lambda: env.loan.serialize)
+
+
+@bench('stdlib_dumps[books-20]')
+def bench_dumps_page(benchmark, env):
+    benchmark(lambda: stdlib_dumps([book.serialize for book in env.page]))
+
+
+@bench('encode_fragments[books-20]')
+def bench_encode_fragments_page(benchmark, env):
+    benchmark(encode_fragments, env.page)
+
+
+@bench('check_password_hash')
+def bench_check_password_hash(benchmark, env):
+    benchmark(check_password_hash, env.password_hash, PASSWORD)
+
+
+@bench('verify_password')
+def bench_verify_password(benchmark, env):
+    benchmark(verify_password, env.password_hash, PASSWORD)
+
+
+@bench('RevokedTokens.is_jti_blacklisted[hit]')
+def bench_jti_blacklisted_hit(benchmark, env):
+    benchmark(RevokedTokens.is_jti_blacklisted, 'revoked-{}'.format(REVOKED_TOKENS // 2))
+
+
+@bench('RevokedTokens.is_jti_blacklisted[miss]')
+def bench_jti_blacklisted_miss(benchmark, env):
+    benchmark(RevokedTokens.is_jti_blacklisted, 'not-revoked')
+
+
+@bench('revocation_cache.is_revoked[hit]')
+def bench_is_revoked_hit(benchmark, env):
+    benchmark(revocation_cache.is_revoked, 'revoked-{}'.format(REVOKED_TOKENS // 2))
+
+
+@bench('revocation_cache.is_revoked[miss]')
+def bench_is_revoked_miss(benchmark, env):
+    benchmark(revocation_cache.is_revoked, 'not-revoked')
+
+
+def _format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.2f}{}'.format(seconds / scale, unit)
+    return '{:.0f}ns'.format(seconds / 1e-9)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, max_regression):
+    """
+    Print the change in median time from a baseline
+    :param results:
+    :param baseline:
+    :param max_regression: percent
+    :return: the names of the benchmarks that regressed beyond max_regression
+    """
+    print('\nChange in median from {} (commit {}, {})'.format(
+        baseline['name'], baseline.get('commit'), baseline['machine']['node']))
+    regressed = []
+    for name, stats in results.items():
+        previous = baseline['benchmarks'].get(name)
+        if previous is None:
+            print('{:<42} {:>12}'.format(name, 'new'))
+            continue
+        change = (stats['median'] - previous['median']) / previous['median'] * 100
+        flag = ''
+        if change > max_regression:
+            regressed.append(name)
+            flag = '  REGRESSED'
+        print('{:<42} {:>12} -> {:>10} {:>+8.1f}%{}'.format(
+            name, _format_time(previous['median']), _format_time(stats['median']), change, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='filter', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--rounds', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.05, help='Seconds each round lasts at least')
+    parser.add_argument('--save', metavar='NAME', help='Store the results as a baseline')
+    parser.add_argument('--compare', metavar='NAME', help='Compare with a stored baseline')
+    parser.add_argument('--max-regression', type=float, default=25,
+                        help='Percent a median may grow before --compare fails')
+    args = parser.parse_args()
+
+    env = Environment()
+    results = {}
+    try:
+        print('{:<42} {:>10} {:>10} {:>10} {:>12} {:>10}'.format('benchmark', 'min', 'median', 'stddev',
+                                                                 'ops/s', 'calls'))
+        for name, func in REGISTRY.items():
+            if args.filter and args.filter not in name:
+                continue
+            benchmark = Benchmark(args.rounds, args.min_time)
+            func(benchmark, env)
+            stats = results[name] = benchmark.stats
+            print('{:<42} {:>10} {:>10} {:>10} {:>12.1f} {:>10}'.format(
+                name, _format_time(stats['min']), _format_time(stats['median']), _format_time(stats['stddev']),
+                stats['ops'], stats['iterations']))
+    finally:
+        env.close()
+
+    if args.save:
+        if not os.path.isdir(BASELINES):
+            os.makedirs(BASELINES)
+        path = os.path.join(BASELINES, '{}.json'.format(args.save))
+        with open(path, 'w') as baseline:
+            json.dump({
+                'name': args.save,
+                'commit': _git_commit(),
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'machine': {'node': platform.node(), 'python': platform.python_version(),
+                            'processor': platform.processor() or platform.machine()},
+                'benchmarks': results
+            }, baseline, indent=2, sort_keys=True)
+        print('\nBaseline saved to {}'.format(path))
+
+    if args.compare:
+        with open(os.path.join(BASELINES, '{}.json'.format(args.compare))) as baseline:
+            regressed = compare(results, json.load(baseline), args.max_regression)
+        if regressed:
+            print('\n{} benchmarks regressed by more than {}%'.format(len(regressed), args.max_regression))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Measure password verifications (logins) per second per core for the
+supported hashing methods and costs, to help choose PASSWORD_HASH_*.
+
+Usage: python benchmarks/bench_password_hashing.py [--seconds 2]
+           [--iterations 50000 150000 600000] [--rounds 10 12 14] [--workers 0]
+
+With --workers N the verifications also run through an N thread pool to
+show the throughput a worker keeps while logins are offloaded.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.passwords import _hash, _verify, bcrypt  # noqa: E402
+
+PASSWORD = 'r7eee#eooM'
+
+
+def logins_per_second(hashed, seconds, workers=0):
+    """
+    Verify a password repeatedly for the given time
+    :param hashed:
+    :param seconds:
+    :param workers:
+    :return:
+    """
+    count = 0
+    started = time.perf_counter()
+    if not workers:
+        while time.perf_counter() - started < seconds:
+            _verify(hashed, PASSWORD)
+            count += 1
+        return count / (time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while time.perf_counter() - started < seconds:
+            list(pool.map(lambda _: _verify(hashed, PASSWORD), range(workers)))
+            count += workers
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=2)
+    parser.add_argument('--iterations', type=int, nargs='*', default=[50000, 150000, 600000])
+    parser.add_argument('--rounds', type=int, nargs='*', default=[10, 12, 14])
+    parser.add_argument('--workers', type=int, default=0)
+    args = parser.parse_args()
+
+    configs = [('pbkdf2:sha256', iterations) for iterations in args.iterations]
+    if bcrypt is not None:
+        configs += [('bcrypt', rounds) for rounds in args.rounds]
+    else:
+        print('bcrypt is not installed, only pbkdf2:sha256 is measured')
+
+    print('{:<15} {:>8} {:>14} {:>10}'.format('method', 'cost', 'logins/s/core', 'ms/login'))
+    for method, cost in configs:
+        hashed = _hash(PASSWORD, method, cost)
+        rate = logins_per_second(hashed, args.seconds)
+        print('{:<15} {:>8} {:>14.1f} {:>10.1f}'.format(method, cost, rate, 1000 / rate))
+        if args.workers:
+            pooled = logins_per_second(hashed, args.seconds, args.workers)
+            print('{:<15} {:>8} {:>14.1f}  with {} threads'.format('', '', pooled, args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+"""
+Load test the API end to end.
+
+Seeds a database with users, books and a borrowing history, then runs
+virtual users that log in and go through a mix of catalogue listings,
+pagination, borrowing, returning and history requests. Reports the
+throughput and the p50/p95/p99 latency of every endpoint and writes them
+to a JSON file, so the results of two commits can be compared.
+
+The seeding drops and recreates every table of --database.
+
+Usage: python benchmarks/loadtest.py [--database sqlite:////tmp/loadtest.db]
+           [--users 100] [--books 2000] [--loans 10000] [--requests 2000]
+           [--concurrency 8] [--gunicorn 4 | --url http://127.0.0.1:5000]
+           [--replay requests.jsonl] [--output results.json] [--compare old.json]
+
+By default requests go through the Flask test client in this process.
+--gunicorn N serves the app from N local gunicorn workers instead and
+--url sends the requests to a server already running on --database.
+--replay runs the requests of a JSON lines file, each with a method,
+a path and optionally a name and a JSON body, instead of the mix.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from urllib.parse import urlsplit
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, ROOT)
+
+from api import create_app, rate_limiter  # noqa: E402
+from api.models import Book, BorrowingHistory, User, db  # noqa: E402
+from api.passwords import hash_password  # noqa: E402
+
+PASSWORD = 'r7eee#eooM'
+
+DEFAULT_DATABASE = 'sqlite:///{}'.format(os.path.join(tempfile.gettempdir(), 'hello-books-loadtest.db'))
+
+# Share of each action in the mix; a borrow is followed by returning the book
+MIX = (
+    ('list', 20),
+    ('paginate', 30),
+    ('cursor', 10),
+    ('history', 20),
+    ('borrow', 20)
+)
+
+SEED_BATCH_SIZE = 1000
+
+
+def build_app(database_url):
+    """
+    Create the production app on database_url with the rate limits off,
+    since every virtual user logs in from the same address
+    :param database_url:
+    :return:
+    """
+    app = create_app('production')
+    app.config.update(SQLALCHEMY_DATABASE_URI=database_url, SQLALCHEMY_REPLICA_URIS=[], RATE_LIMITS={})
+    rate_limiter.init_app(app)
+    return app
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), SEED_BATCH_SIZE):
+        db.session.execute(table.insert(), rows[start:start + SEED_BATCH_SIZE])
+    db.session.commit()
+
+
+def seed(app, users, books, loans):
+    """
+    Recreate the tables and fill them with returned loans of random books
+    :param app:
+    :param users:
+    :param books:
+    :param loans:
+    :return: the emails of the users
+    """
+    rng = random.Random(0)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        # One hash for everyone, with the configured cost, so seeding stays fast
+        hashed = hash_password(PASSWORD)
+        emails = ['loadtest{}@example.com'.format(index) for index in range(users)]
+        _insert(User.__table__, [{
+            'username': 'loadtest{}'.format(index),
+            'email': email,
+            'user_password': hashed,
+            'is_admin': False,
+            'created_at': date.today()
+        } for index, email in enumerate(emails)])
+
+        _insert(Book.__table__, [{
+            'title': 'Book number {}'.format(book_id),
+            'author': 'Author {}'.format(book_id % 300),
+            'description': 'A description of book {} that is a sentence or two long.'.format(book_id),
+            'availability': True,
+            'created_at': date.today(),
+            'deleted': False
+        } for book_id in range(1, books + 1)])
+
+        today = datetime.now()
+        rows = []
+        for _ in range(loans):
+            book_id = rng.randint(1, books)
+            borrowed = today - timedelta(days=rng.randint(7, 365))
+            rows.append({
+                'book_id': book_id,
+                'book_title': 'Book number {}'.format(book_id),
+                'book_author': 'Author {}'.format(book_id % 300),
+                'book_description': 'A description of book {} that is a sentence or two long.'.format(book_id),
+                'user_id': rng.randint(1, users),
+                'date_borrowed': borrowed.date(),
+                'due_date': (borrowed + timedelta(days=6)).date(),
+                'returned': True,
+                'returned_date': borrowed + timedelta(days=rng.randint(1, 10)),
+                'overdue': False
+            })
+        _insert(BorrowingHistory.__table__, rows)
+        db.session.remove()
+    return emails
+
+
+class InProcessClient(object):
+    """
+    Sends requests through the Flask test client.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Authorization': 'Bearer {}'.format(token)} if token else {}
+        data = json.dumps(body) if body is not None else None
+        response = self.client.open(path, method=method, data=data, headers=headers,
+                                    content_type='application/json')
+        return response.status_code, response.get_data()
+
+
+class HTTPClient(object):
+    """
+    Sends requests to a server over one keep-alive connection.
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.connection = None
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = 'Bearer {}'.format(token)
+        data = json.dumps(body) if body is not None else None
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.connection.request(method, path, body=data, headers=headers)
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                # The server closed the kept alive connection, reconnect once
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+
+def percentile(ordered, fraction):
+    """
+    Nearest rank percentile of a sorted list
+    :param ordered:
+    :param fraction:
+    :return:
+    """
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Recorder(object):
+    """
+    Latencies and statuses of the requests of every virtual user.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+    def timed(self, name, client, method, path, body=None, token=None):
+        started = time.perf_counter()
+        try:
+            status, data = client.request(method, path, body, token)
+        except Exception:
+            status, data = 'error', b''
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            statuses = self.statuses.setdefault(name, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return status, data
+
+    def summary(self, duration):
+        """
+        Throughput and latency percentiles, in milliseconds, per endpoint and overall
+        :param duration:
+        :return:
+        """
+        def describe(latencies, statuses):
+            ordered = sorted(latencies)
+            errors = sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 500)
+            return {
+                'requests': len(ordered),
+                'errors': errors,
+                'statuses': statuses,
+                'throughput': round(len(ordered) / duration, 2),
+                'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+                'p50': round(percentile(ordered, 0.50) * 1000, 3),
+                'p95': round(percentile(ordered, 0.95) * 1000, 3),
+                'p99': round(percentile(ordered, 0.99) * 1000, 3),
+                'max': round(ordered[-1] * 1000, 3)
+            }
+
+        endpoints = {name: describe(latencies, self.statuses[name])
+                     for name, latencies in sorted(self.latencies.items())}
+        everything = [latency for latencies in self.latencies.values() for latency in latencies]
+        totals = {}
+        for statuses in self.statuses.values():
+            for status, count in statuses.items():
+                totals[status] = totals.get(status, 0) + count
+        return endpoints, describe(everything, totals)
+
+
+def virtual_user(index, client, email, books, requests, recorder, replay):
+    """
+    Log in, then make requests until the user's share is done
+    :param index:
+    :param client:
+    :param email:
+    :param books:
+    :param requests:
+    :param recorder:
+    :param replay:
+    :return:
+    """
+    rng = random.Random(index)
+    status, data = recorder.timed('login', client, 'POST', '/api/v2/auth/login',
+                                  {'email': email, 'password': PASSWORD})
+    if status != 200:
+        return
+    token = json.loads(data.decode('utf-8'))['access_token']
+
+    actions = [action for action, weight in MIX for _ in range(weight)]
+    pages = max(1, books // 20)
+    made = 0
+    while made < requests:
+        if replay:
+            entry = replay[made % len(replay)]
+            recorder.timed(entry.get('name') or '{} {}'.format(entry['method'], entry['path']), client,
+                           entry['method'], entry['path'], entry.get('body'), token)
+            made += 1
+            continue
+
+        action = rng.choice(actions)
+        if action == 'list':
+            recorder.timed('list', client, 'GET', '/api/v2/books', token=token)
+        elif action == 'paginate':
+            recorder.timed('paginate', client, 'GET',
+                           '/api/v2/books?page={}&limit=20'.format(rng.randint(1, pages)), token=token)
+        elif action == 'cursor':
+            recorder.timed('cursor', client, 'GET', '/api/v2/books?cursor=&limit=20', token=token)
+        elif action == 'history':
+            recorder.timed('history', client, 'GET', '/api/v2/users/books?page=1&limit=20', token=token)
+        else:
+            book_id = rng.randint(1, books)
+            status, _ = recorder.timed('borrow', client, 'POST', '/api/v2/users/book/{}'.format(book_id),
+                                       token=token)
+            if status == 200:
+                recorder.timed('return', client, 'PUT', '/api/v2/users/book/{}'.format(book_id), token=token)
+                made += 1
+        made += 1
+
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_gunicorn(workers, database_url):
+    """
+    Serve the load test app from local gunicorn workers
+    :param workers:
+    :param database_url:
+    :return: the server process and its URL
+    """
+    port = _free_port()
+    env = dict(os.environ, LOADTEST_DATABASE_URL=database_url, PYTHONPATH=ROOT)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+                               '--bind', '127.0.0.1:{}'.format(port), '--chdir', BENCHMARKS,
+                               'loadtest:application'], env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited with status {}'.format(server.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, 'http://127.0.0.1:{}'.format(port)
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start listening on port {}'.format(port))
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Print how the latency and throughput of each endpoint changed from a baseline
+    :param results:
+    :param baseline:
+    :return:
+    """
+    print('\nChange from {} (commit {})'.format(baseline.get('timestamp'), baseline.get('commit')))
+    print('{:<12} {:>12} {:>10} {:>10}'.format('endpoint', 'throughput', 'p50', 'p95'))
+    for name, current in sorted(results['endpoints'].items()):
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous:
+            continue
+        changes = ['{:+.1f}%'.format((current[key] - previous[key]) / previous[key] * 100) if previous[key] else '-'
+                   for key in ('throughput', 'p50', 'p95')]
+        print('{:<12} {:>12} {:>10} {:>10}'.format(name, *changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--loans', type=int, default=10000)
+    parser.add_argument('--no-seed', dest='seed', action='store_false', help='Reuse the data of an earlier run')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Requests over all virtual users, not counting logins')
+    parser.add_argument('--concurrency', type=int, default=8, help='Virtual users running at once')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--gunicorn', type=int, metavar='WORKERS')
+    target.add_argument('--url')
+    parser.add_argument('--replay', help='JSON lines file of requests to make instead of the mix')
+    parser.add_argument('--output', default='loadtest-results.json')
+    parser.add_argument('--compare', help='Results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    replay = None
+    if args.replay:
+        with open(args.replay) as replay_file:
+            replay = [json.loads(line) for line in replay_file if line.strip()]
+
+    app = build_app(args.database)
+    if args.seed:
+        started = time.perf_counter()
+        emails = seed(app, args.users, args.books, args.loans)
+        print('Seeded {} users, {} books and {} loans in {:.1f}s'.format(
+            args.users, args.books, args.loans, time.perf_counter() - started))
+    else:
+        emails = ['loadtest{}@example.com'.format(index) for index in range(args.users)]
+
+    server = None
+    if args.gunicorn:
+        server, url = start_gunicorn(args.gunicorn, args.database)
+        mode = 'gunicorn'
+    else:
+        url = args.url
+        mode = 'http' if url else 'in-process'
+
+    recorder = Recorder()
+    share, remainder = divmod(args.requests, args.concurrency)
+    threads = []
+    for index in range(args.concurrency):
+        client = HTTPClient(url) if url else InProcessClient(app)
+        threads.append(threading.Thread(target=virtual_user, args=(
+            index, client, emails[index % len(emails)], args.books, share + (index < remainder), recorder, replay)))
+
+    started = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    duration = time.perf_counter() - started
+
+    endpoints, total = recorder.summary(duration)
+    results = {
+        'commit': _git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'mode': mode,
+        'database': urlsplit(args.database).scheme,
+        'settings': {key: getattr(args, key) for key in ('users', 'books', 'loans', 'requests', 'concurrency',
+                                                         'gunicorn', 'replay')},
+        'duration': round(duration, 3),
+        'endpoints': endpoints,
+        'total': total
+    }
+
+    print('\n{:<12} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, stats in sorted(endpoints.items()) + [('total', total)]:
+        print('{:<12} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}'.format(
+            name, stats['requests'], stats['errors'], stats['throughput'], stats['p50'], stats['p95'], stats['p99']))
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print('\nResults written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if os.getenv('LOADTEST_DATABASE_URL'):
+    # Loaded by the gunicorn workers started by start_gunicorn
+    application = build_app(os.environ['LOADTEST_DATABASE_URL'])
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 import os
+import time
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 from api import db, create_app
+from api.admin.importer import guess_format, import_books as import_books_from
+from api.jobs import work
+from api.overdue import process_overdue
 
 app = create_app(config_name=os.getenv('APP_SETTINGS'))
 migrate = Migrate(app, db)
@@ -9,5 +13,42 @@ manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.option('path', help='CSV or JSON lines file with title, author, description and availability')
+@manager.option('-f', '--format', dest='fmt', default=None, help='csv or jsonl, guessed from the file name by default')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500, help='Books inserted per transaction')
+def import_books(path, fmt=None, batch_size=500):
+    """
+    Bulk import books from a file
+    """
+    with open(path, 'rb') as stream:
+        summary = import_books_from(stream, fmt or guess_format(path), batch_size)
+
+    for error in summary['errors']:
+        print('Row {row}: {message}'.format(**error))
+    print('Imported {} books, {} rows rejected.'.format(summary['imported'], len(summary['errors'])))
+
+
+@manager.option('--once', dest='once', action='store_true', default=False, help='Run due jobs once and exit')
+def worker(once=False):
+    """
+    Run queued and periodic background jobs
+    """
+    ran = work(once=once)
+    if once:
+        print('Ran {} jobs.'.format(ran))
+
+
+@manager.option('--full', dest='full', action='store_true', default=False,
+                help='Check every open loan instead of those due since the last run')
+def overdue(full=False):
+    """
+    Flag overdue loans
+    """
+    started = time.time()
+    flagged = process_overdue(full=full)
+    print('Flagged {} overdue loans in {:.2f}s.'.format(flagged, time.time() - started))
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,24 @@
+"""book revision
+
+Revision ID: 2d1924b72718
+Revises: c47d1f9e2b35
+Create Date: 2026-10-18 12:07:55.274844
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d1924b72718'
+down_revision = 'c47d1f9e2b35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('books', sa.Column('revision', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('books', 'revision')
@@ -0,0 +1,28 @@
+"""borrowing history and revocation indexes
+
+Revision ID: 3f2a9c1d7b4e
+Revises: 6dd990305000
+Create Date: 2026-10-18 12:05:41.218334
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b4e'
+down_revision = '6dd990305000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_borrowed_books_user_id_returned', 'borrowed_books', ['user_id', 'returned'], unique=False)
+    op.create_index('ix_borrowed_books_book_id_returned', 'borrowed_books', ['book_id', 'returned'], unique=False)
+    op.create_index(op.f('ix_revoked_tokens_time_revoked'), 'revoked_tokens', ['time_revoked'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_revoked_tokens_time_revoked'), table_name='revoked_tokens')
+    op.drop_index('ix_borrowed_books_book_id_returned', table_name='borrowed_books')
+    op.drop_index('ix_borrowed_books_user_id_returned', table_name='borrowed_books')
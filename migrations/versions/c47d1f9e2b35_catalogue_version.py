@@ -0,0 +1,30 @@
+"""catalogue version stamp
+
+Revision ID: c47d1f9e2b35
+Revises: 8b1e4d2c6a90
+Create Date: 2026-10-18 13:40:52.104417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47d1f9e2b35'
+down_revision = '8b1e4d2c6a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('catalogue_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute("INSERT INTO catalogue_version (id, version, updated_at) VALUES (1, 0, CURRENT_TIMESTAMP)")
+
+
+def downgrade():
+    op.drop_table('catalogue_version')
@@ -0,0 +1,31 @@
+"""overdue engine
+
+Revision ID: f18382f0b64b
+Revises: 571938682f77
+Create Date: 2026-10-18 12:19:53.996020
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f18382f0b64b'
+down_revision = '571938682f77'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('watermarks',
+    sa.Column('name', sa.String(length=60), nullable=False),
+    sa.Column('value', sa.Date(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.create_index('ix_borrowed_books_returned_due_date', 'borrowed_books', ['returned', 'due_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_borrowed_books_returned_due_date', table_name='borrowed_books')
+    op.drop_table('watermarks')
@@ -1,6 +1,11 @@
 import unittest
 import json
+from io import BytesIO
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
 from api import create_app, db
+from api.models import InstrumentedQueuePool
 
 
 class AdminTestCase(unittest.TestCase):
@@ -79,6 +84,94 @@ class AdminTestCase(unittest.TestCase):
         # Test if the same book can be added again
         self.assertIn('Book with that title already exists.', str(response.data))
 
+    def test_bulk_import_books(self):
+        """
+        Tests whether books can be imported from a CSV file
+        :return:
+        """
+        access_token = self.register_login_admin()
+        headers = {'Authorization': 'Bearer {}'.format(access_token)}
+
+        self.client.post('/api/v2/books', data=json.dumps(self.book),
+                         headers=dict(headers, **{'content-type': 'application/json'}))
+
+        csv_file = (b'title,author,description,availability\n'
+                    b'Kamusi ya Methali,Brian Mecha,Already in the library,true\n'
+                    b'The River Between,Ngugi wa Thiong\'o,"A novel, set in Kenya",true\n'
+                    b',Nobody,No title,true\n'
+                    b'Blossoms of the Savannah,Henry Ole Kulet,A novel,false\n')
+        response = self.client.post('/api/v2/books/import',
+                                    data={'file': (BytesIO(csv_file), 'books.csv')},
+                                    headers=headers, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        summary = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(summary['imported'], 2)
+        self.assertEqual([error['row'] for error in summary['errors']], [1, 3])
+        self.assertIn('Book must have a Title', str(response.data))
+
+        response = self.client.get('/api/v2/books', content_type="application/json")
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))), 3)
+
+        # Import JSON lines sent as the request body
+        jsonl = b'{"title": "Weep Not, Child", "author": "Ngugi", "description": "A novel"}\nnot json\n'
+        response = self.client.post('/api/v2/books/import?format=jsonl', data=jsonl,
+                                    headers=dict(headers, **{'content-type': 'application/x-ndjson'}))
+        summary = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(summary['imported'], 1)
+        self.assertEqual(summary['errors'], [{'row': 2, 'message': 'Invalid JSON'}])
+
+    def test_export_books(self):
+        """
+        Tests whether admins can stream the catalogue as JSON lines and CSV
+        :return:
+        """
+        access_token = self.register_login_admin()
+        headers = {'Authorization': 'Bearer {}'.format(access_token)}
+        for title in ('Kamusi ya Methali', 'The River Between'):
+            self.client.post('/api/v2/books', data=json.dumps(dict(self.book, title=title)),
+                             headers=dict(headers, **{'content-type': 'application/json'}))
+
+        response = self.client.get('/api/v2/admin/export/books', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['title'] for line in lines], ['Kamusi ya Methali', 'The River Between'])
+
+        response = self.client.get('/api/v2/admin/export/books?format=csv', headers=headers)
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('book_id,title,author'))
+
+        response = self.client.get('/api/v2/admin/export/history', headers=headers)
+        self.assertEqual(response.data, b'')
+
+        response = self.client.get('/api/v2/admin/export/users', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_connection_pool_stats(self):
+        """
+        Tests whether admins can see the connection pool and the pool counts waits
+        :return:
+        """
+        access_token = self.register_login_admin()
+        response = self.client.get('/api/v2/admin/pool',
+                                   headers={'Authorization': 'Bearer {}'.format(access_token)})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('pool', json.loads(response.data.decode('utf-8')))
+
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.1)
+        connection = engine.connect()
+        self.assertEqual(engine.pool.stats()['checked_out'], 1)
+        with self.assertRaises(PoolTimeoutError):
+            engine.connect()
+        connection.close()
+        stats = engine.pool.stats()
+        self.assertEqual((stats['checkouts'], stats['timeouts'], stats['checked_out']), (2, 1, 0))
+        self.assertGreaterEqual(stats['wait_max'], 0.1)
+        engine.dispose()
+
     def test_add_book_without_title(self):
         """
         Tests whether a book can be added without a title
@@ -1,7 +1,18 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
 import unittest
 import json
+from unittest import mock
+from datetime import date, timedelta
 
-from api import create_app, db
+from api import create_app, db, response_encoder, revocation_cache
+from api.cache import FileCache, LRUCache, encode_fragments
+from api.encoders import orjson, orjson_dumps, stdlib_dumps
+from api.metrics import MmapStore, aggregate, exposition
+from api.models import Book, BorrowingHistory, RevokedTokens
+from api.overdue import process_overdue
 from tests.test_users import UserTestCase
 from tests.test_admin import AdminTestCase
 
@@ -42,13 +53,13 @@ class BookTestCase(unittest.TestCase):
         with self.app.app_context():
             db.create_all()
 
-    # def test_books(self):
-    #     """
-    #     Tests to get all books
-    #     :return:
-    #     """
-    #     response = self.client.get('/api/v2/books', content_type="application/json")
-    #     self.assertEqual(response.status_code, 204)
+    def test_books(self):
+        """
+        Tests to get all books
+        :return:
+        """
+        response = self.client.get('/api/v2/books', content_type="application/json")
+        self.assertEqual(response.status_code, 204)
 
     def test_get_a_single_book(self):
         """
@@ -126,6 +137,555 @@ class BookTestCase(unittest.TestCase):
                                             'Authorization': 'Bearer {}'.format(access_token)})
         self.assertEqual(response.status_code, 200)
 
+        # Test to page through borrowing history with a cursor
+        response = self.client.get('/api/v2/users/books?cursor=&limit=1',
+                                   headers={'content-type': 'application/json',
+                                            'Authorization': 'Bearer {}'.format(access_token)})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['next'], 'None')
+
+        # Test to filter borrowing history by returned status
+        response = self.client.get('/api/v2/users/books?returned=true',
+                                   headers={'content-type': 'application/json',
+                                            'Authorization': 'Bearer {}'.format(access_token)})
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))), 1)
+
+        response = self.client.get('/api/v2/users/books?returned=false',
+                                   headers={'content-type': 'application/json',
+                                            'Authorization': 'Bearer {}'.format(access_token)})
+        self.assertIn('User does not have unreturned Books', str(response.data))
+
+    def test_bulk_borrow_and_return(self):
+        """
+        Tests whether several books can be borrowed and returned at once
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+        access_token = UserTestCase.register_login_user(self)
+        headers = {'content-type': 'application/json',
+                   'Authorization': 'Bearer {}'.format(access_token)}
+
+        for title in ['Book One', 'Book Two']:
+            book = dict(self.book, title=title)
+            self.client.post('/api/v2/books', data=json.dumps(book),
+                             headers={'content-type': 'application/json',
+                                      'Authorization': 'Bearer {}'.format(admin_access_token)})
+
+        response = self.client.post('/api/v2/users/books', data=json.dumps({'book_ids': [1, 2, 3, 1]}),
+                                    headers=headers)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data.decode('utf-8'))['results']
+        self.assertEqual([(result['book_id'], result['status']) for result in results],
+                         [(1, 200), (2, 200), (3, 403)])
+        self.assertEqual(results[2]['message'], 'Book does not exist')
+
+        response = self.client.post('/api/v2/users/books', data=json.dumps({'book_ids': [1]}), headers=headers)
+        results = json.loads(response.data.decode('utf-8'))['results']
+        self.assertEqual(results[0]['message'], 'This Book is not available for borrowing.')
+
+        # returned=true keeps its original meaning of the whole history
+        response = self.client.get('/api/v2/users/books?returned=true', headers=headers)
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))), 2)
+
+        response = self.client.put('/api/v2/users/books', data=json.dumps({'book_ids': [1, 2]}), headers=headers)
+        results = json.loads(response.data.decode('utf-8'))['results']
+        self.assertEqual([result['status'] for result in results], [200, 200])
+
+        response = self.client.get('/api/v2/users/books?returned=true', headers=headers)
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))), 2)
+
+        response = self.client.put('/api/v2/users/books', data=json.dumps({'book_ids': [1]}), headers=headers)
+        results = json.loads(response.data.decode('utf-8'))['results']
+        self.assertEqual(results[0]['message'], 'This book is not borrowed.')
+
+        response = self.client.post('/api/v2/users/books', data=json.dumps({'book_ids': 'all'}), headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_concurrent_loans(self):
+        """
+        Tests the losing side of a concurrent borrow and return
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+        access_token = UserTestCase.register_login_user(self)
+        headers = {'content-type': 'application/json',
+                   'Authorization': 'Bearer {}'.format(access_token)}
+        admin_headers = {'content-type': 'application/json',
+                         'Authorization': 'Bearer {}'.format(admin_access_token)}
+        self.client.post('/api/v2/books', data=json.dumps(self.book), headers=admin_headers)
+
+        response = self.client.post('/api/v2/users/book/1', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        # The second borrower's conditional UPDATE changes no row
+        response = self.client.post('/api/v2/users/book/1', headers=admin_headers)
+        self.assertEqual(response.status_code, 403)
+        self.assertIn("This Book is not available for borrowing.", str(response.data))
+        with self.app.app_context():
+            self.assertEqual(BorrowingHistory.query.filter_by(book_id=1).count(), 1)
+
+        # Returning twice closes the loan once
+        response = self.client.put('/api/v2/users/book/1', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        with self.app.app_context():
+            returned_date = BorrowingHistory.query.filter_by(book_id=1).one().returned_date
+        response = self.client.put('/api/v2/users/book/1', headers=headers)
+        self.assertEqual(response.status_code, 403)
+        self.assertIn("This book is not borrowed.", str(response.data))
+        with self.app.app_context():
+            self.assertEqual(BorrowingHistory.query.filter_by(book_id=1).one().returned_date, returned_date)
+
+        # A bulk borrow that keeps losing the race answers 409
+        self.client.post('/api/v2/users/book/1', headers=admin_headers)
+        stale = staticmethod(lambda book_ids: {book_id: True for book_id in book_ids})
+        with mock.patch.object(BorrowingHistory, '_lock_books', stale):
+            response = self.client.post('/api/v2/users/books', data=json.dumps({'book_ids': [1]}), headers=headers)
+        self.assertEqual(response.status_code, 409)
+        with self.app.app_context():
+            self.assertEqual(BorrowingHistory.query.filter_by(book_id=1).count(), 2)
+
+    def test_search_books(self):
+        """
+        Tests whether books can be searched by title, author and description
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+
+        books = [
+            {'title': 'The River Between', 'author': 'Ngugi wa Thiongo', 'description': 'Two villages by a river'},
+            {'title': 'Petals of Blood', 'author': 'Ngugi wa Thiongo', 'description': 'A murder in Ilmorog'},
+            {'title': 'Kamusi ya Methali', 'author': 'Brian Mecha', 'description': 'A collection of sayings'},
+        ]
+        for book in books:
+            self.client.post('/api/v2/books', data=json.dumps(book),
+                             headers={'content-type': 'application/json',
+                                      'Authorization': 'Bearer {}'.format(admin_access_token)})
+
+        response = self.client.get('/api/v2/books/search?q=ngugi', content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(sorted(book['title'] for book in data['results']),
+                         ['Petals of Blood', 'The River Between'])
+
+        response = self.client.get('/api/v2/books/search?q=river&limit=1', content_type="application/json")
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([book['title'] for book in data['results']], ['The River Between'])
+        self.assertEqual(data['next'], 'None')
+
+        response = self.client.get('/api/v2/books/search?q=dictionary', content_type="application/json")
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['results'], [])
+
+        response = self.client.get('/api/v2/books/search?q=', content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+        # Ranked results have no cursor order
+        response = self.client.get('/api/v2/books/search?q=ngugi&cursor=', content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_conditional_get_books(self):
+        """
+        Tests that catalogue reads carry an ETag and answer 304 until the catalogue changes
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+        headers = {'content-type': 'application/json', 'Authorization': 'Bearer {}'.format(admin_access_token)}
+        self.client.post('/api/v2/books', data=json.dumps(self.book), headers=headers)
+
+        response = self.client.get('/api/v2/books', content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+
+        response = self.client.get('/api/v2/books', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = self.client.get('/api/v2/books?limit=1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        self.client.post('/api/v2/books', data=json.dumps(dict(self.book, title='Another Title')), headers=headers)
+        response = self.client.get('/api/v2/books', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_cached_books(self):
+        """
+        Tests that catalogue reads are cached until the catalogue changes
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+        headers = {'content-type': 'application/json', 'Authorization': 'Bearer {}'.format(admin_access_token)}
+        self.client.post('/api/v2/books', data=json.dumps(self.book), headers=headers)
+
+        response = self.client.get('/api/v2/books?limit=5', content_type="application/json")
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        response = self.client.get('/api/v2/books?page=1&limit=05', content_type="application/json")
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))['results']), 1)
+
+        self.client.post('/api/v2/books', data=json.dumps(dict(self.book, title='Another Title')), headers=headers)
+        response = self.client.get('/api/v2/books?limit=5', content_type="application/json")
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))['results']), 2)
+
+        # Arguments outside the key bypass the cache instead of filling it
+        response = self.client.get('/api/v2/books?limit=5&anything=1', content_type="application/json")
+        self.assertNotIn('X-Cache', response.headers)
+
+        response = self.client.get('/api/v2/admin/cache', headers=headers)
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual((data['hits'], data['misses'], data['entries']), (1, 2, 1))
+
+    def test_cache_bounds(self):
+        """
+        Tests that the response cache backends stay within their bounds
+        :return:
+        """
+        cache = LRUCache(10, maxbytes=10)
+        cache.set('a', b'12345')
+        cache.set('b', b'1234')
+        cache.set('c', b'123')
+        self.assertEqual((len(cache), cache.bytes), (2, 7))
+        self.assertIsNone(cache.get('a'))
+        cache.set('d', b'12345678901')
+        self.assertIsNone(cache.get('d'))
+        cache.set('b', b'12')
+        self.assertEqual(cache.bytes, 5)
+
+        directory = tempfile.mkdtemp()
+        try:
+            cache = FileCache(directory, maxsize=2)
+            for written, key in enumerate(('a', 'b', 'c'), 1):
+                cache.set(key, (200, 'application/json', key.encode('ascii')))
+                os.utime(cache._path(key), (written, written))
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('c'), (200, 'application/json', b'c'))
+
+            # Clearing leaves other workers' writes in progress alone
+            open(os.path.join(directory, '.tmpwriting'), 'wb').close()
+            cache.clear()
+            self.assertEqual(os.listdir(directory), ['.tmpwriting'])
+
+            # Failed writes are skipped and leave no temporary file behind
+            with mock.patch('api.cache.os.replace', side_effect=OSError('disk full')):
+                cache.set('d', (200, 'application/json', b'd'))
+            self.assertIsNone(cache.get('d'))
+            self.assertEqual(os.listdir(directory), ['.tmpwriting'])
+
+            # Directories other users could write to are refused
+            os.chmod(directory, 0o777)
+            self.assertRaises(RuntimeError, FileCache, directory)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_book_fragments_follow_updates(self):
+        """
+        Tests that cached book JSON is replaced when the book is edited or borrowed
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+        headers = {'content-type': 'application/json', 'Authorization': 'Bearer {}'.format(admin_access_token)}
+        self.client.post('/api/v2/books', data=json.dumps(self.book), headers=headers)
+        self.client.get('/api/v2/book/1', content_type="application/json")
+
+        self.client.put('/api/v2/book/1', data=json.dumps(dict(self.book, title='New Title')), headers=headers)
+        self.client.post('/api/v2/users/book/1', headers=headers)
+
+        response = self.client.get('/api/v2/book/1', content_type="application/json")
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(data['title'], 'New Title')
+        self.assertFalse(data['availability'])
+
+    def test_deleted_book_fragments(self):
+        """
+        Tests that a book added after a delete is not served the deleted book's JSON
+        :return:
+        """
+        with self.app.test_request_context('/api/v2/book/1'):
+            book = Book(**self.book)
+            book.create_book()
+            book_id = book.book_id
+            encode_fragments([book])
+
+            book.delete_book()
+            replacement = Book(**dict(self.book, title='The River Between'))
+            replacement.create_book()
+            self.assertNotEqual(replacement.book_id, book_id)
+            self.assertIn(b'The River Between', encode_fragments([replacement])[0])
+
+    def test_json_encoders_agree(self):
+        """
+        Tests that the stdlib and orjson encoders return the same borrowing history
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+        headers = {'content-type': 'application/json', 'Authorization': 'Bearer {}'.format(admin_access_token)}
+        self.client.post('/api/v2/books', data=json.dumps(self.book), headers=headers)
+        self.client.post('/api/v2/users/book/1', headers=headers)
+        self.client.put('/api/v2/users/book/1', headers=headers)
+        self.client.post('/api/v2/users/book/1', headers=headers)
+
+        histories = []
+        pages = []
+        for encoder in ('stdlib', 'auto'):
+            self.app.config['JSON_ENCODER'] = encoder
+            response_encoder.init_app(self.app)
+            self.app.extensions['fragment_cache'].clear()
+            response = self.client.get('/api/v2/users/books', headers=headers)
+            histories.append(json.loads(response.data.decode('utf-8')))
+            # Paged results are spliced into an envelope
+            response = self.client.get('/api/v2/users/books?limit=1', headers=headers)
+            pages.append(json.loads(response.data.decode('utf-8')))
+
+        self.assertEqual(histories[0], histories[1])
+        self.assertEqual(pages[0], pages[1])
+        self.assertEqual(pages[0]['results'], histories[0][:1])
+        self.assertTrue(histories[0][0]['due_date'].endswith(' 00:00:00 GMT'))
+        self.assertTrue(histories[0][0]['returned_date'].endswith(' GMT'))
+        self.assertIsNone(histories[0][1]['returned_date'])
+
+        with self.app.app_context():
+            loans = [loan.serialize for loan in BorrowingHistory.query.all()]
+            if orjson is not None:
+                self.assertEqual(json.loads(orjson_dumps(loans).decode('utf-8')),
+                                 json.loads(stdlib_dumps(loans).decode('utf-8')))
+            # Dates reach the encoders already formatted
+            self.assertEqual(json.loads(stdlib_dumps(loans).decode('utf-8')), loans)
+
+    def test_overdue_loans(self):
+        """
+        Tests that loans past their due date are flagged incrementally and listed with fines
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+        headers = {'content-type': 'application/json', 'Authorization': 'Bearer {}'.format(admin_access_token)}
+        self.client.post('/api/v2/books', data=json.dumps(self.book), headers=headers)
+        self.client.post('/api/v2/users/book/1', headers=headers)
+
+        with self.app.app_context():
+            BorrowingHistory.query.update({'due_date': date.today() - timedelta(days=3)})
+            db.session.commit()
+            self.assertEqual(process_overdue(), 1)
+            self.assertEqual(process_overdue(), 0)
+
+        response = self.client.get('/api/v2/admin/overdue', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        loans = json.loads(response.data.decode('utf-8'))['results']
+        self.assertEqual(len(loans), 1)
+        self.assertTrue(loans[0]['overdue'])
+        self.assertEqual(loans[0]['days_overdue'], 3)
+        self.assertEqual(loans[0]['fine'], 3 * self.app.config['OVERDUE_FINE_PER_DAY'])
+
+        response = self.client.get('/api/v2/admin/overdue?cursor=', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+        self.client.put('/api/v2/users/book/1', headers=headers)
+        response = self.client.get('/api/v2/admin/overdue', headers=headers)
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['results'], [])
+
+    def test_paginated_books(self):
+        """
+        Tests that books are paginated with page and limit
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+
+        for title in ['Book One', 'Book Two', 'Book Three']:
+            book = dict(self.book, title=title)
+            self.client.post('/api/v2/books', data=json.dumps(book),
+                             headers={'content-type': 'application/json',
+                                      'Authorization': 'Bearer {}'.format(admin_access_token)})
+
+        response = self.client.get('/api/v2/books?limit=2', content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(data['previous'], 'None')
+        self.assertEqual(data['next'], '/api/v2/books?page=2&limit=2')
+
+        response = self.client.get('/api/v2/books?page=2&limit=2', content_type="application/json")
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['next'], 'None')
+
+        response = self.client.get('/api/v2/books?page=3&limit=2', content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+
+        for query in ('page=0&limit=2', 'page=-1&limit=2', 'page=abc', 'limit=0', 'limit=abc'):
+            response = self.client.get('/api/v2/books?' + query, content_type="application/json")
+            self.assertEqual(response.status_code, 400, query)
+
+        # Oversized pages are clamped rather than refused, old clients keep working
+        response = self.client.get('/api/v2/books?limit=500', content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual(data['next'], 'None')
+
+        response = self.client.get('/api/v2/books', content_type="application/json")
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))), 3)
+
+    def test_cursor_paginated_books(self):
+        """
+        Tests that books can be paged through with a cursor
+        :return:
+        """
+        admin_access_token = AdminTestCase.register_login_admin(self)
+
+        for title in ['Book One', 'Book Two', 'Book Three']:
+            book = dict(self.book, title=title)
+            self.client.post('/api/v2/books', data=json.dumps(book),
+                             headers={'content-type': 'application/json',
+                                      'Authorization': 'Bearer {}'.format(admin_access_token)})
+
+        response = self.client.get('/api/v2/books?cursor=&limit=2', content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([book['title'] for book in data['results']], ['Book Three', 'Book Two'])
+        self.assertIn('cursor=', data['next'])
+
+        response = self.client.get(data['next'], content_type="application/json")
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([book['title'] for book in data['results']], ['Book One'])
+        self.assertEqual(data['next'], 'None')
+
+        for cursor in ('notacursor', 'WyJhYmMiLCAiZGVmIl0='):
+            response = self.client.get('/api/v2/books?cursor=' + cursor, content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.data.decode('utf-8')), {'message': 'Invalid cursor'})
+
+    def test_request_instrumentation(self):
+        """
+        Tests whether requests report their queries and log slow ones
+        :return:
+        """
+        self.app.config['SERVER_TIMING_HEADER'] = True
+        self.app.config['SLOW_QUERY_THRESHOLD'] = 1e-9
+        with self.assertLogs('api.instrumentation', level='WARNING') as logs:
+            response = self.client.get('/api/v2/books')
+        self.assertIn('Slow query in books.get_all_books', logs.output[0])
+
+        timings = response.headers.getlist('Server-Timing')
+        self.assertEqual([timing.split(';')[0] for timing in timings], ['db', 'app'])
+        queries = int(timings[0].split('desc="')[1].split()[0])
+        self.assertGreater(queries, 0)
+        self.assertEqual(len(logs.output), queries)
+
+    def test_metrics(self):
+        """
+        Tests whether /metrics reports requests, statuses and cache lookups
+        :return:
+        """
+        with self.app.app_context():
+            db.session.add(Book(**self.book))
+            db.session.commit()
+
+        self.client.get('/api/v2/books')
+        self.client.get('/api/v2/books')
+        self.client.get('/api/v2/book/404')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertIn('hellobooks_http_requests_total{blueprint="books",endpoint="books.get_all_books",'
+                      'method="GET",status="200"} 2.0', lines)
+        self.assertIn('hellobooks_http_requests_total{blueprint="books",endpoint="books.get_book_by_id",'
+                      'method="GET",status="404"} 1.0', lines)
+        self.assertIn('hellobooks_http_request_duration_seconds_bucket{blueprint="books",'
+                      'endpoint="books.get_all_books",le="+Inf"} 2.0', lines)
+        self.assertIn('hellobooks_response_cache_requests_total{endpoint="books.get_all_books",result="hit"} 1.0',
+                      lines)
+
+    def test_metrics_shared_between_processes(self):
+        """
+        Tests whether the metrics of exited workers keep their counters but not their gauges
+        :return:
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            def worker():
+                store = MmapStore(directory)
+                store.inc([(('hellobooks_db_queries_total', (('endpoint', 'books.search'),)), 3)])
+                store.set([(('hellobooks_db_pool_checked_out', (('database', 'primary'),)), 4)])
+
+            process = multiprocessing.get_context('fork').Process(target=worker)
+            process.start()
+            process.join()
+
+            store = MmapStore(directory)
+            store.inc([(('hellobooks_db_queries_total', (('endpoint', 'books.search'),)), 2)] * 2)
+            store.set([(('hellobooks_db_pool_checked_out', (('database', 'primary'),)), 1)])
+            lines = exposition(aggregate(store.collect())).splitlines()
+            self.assertIn('hellobooks_db_queries_total{endpoint="books.search"} 7.0', lines)
+            self.assertIn('hellobooks_db_pool_checked_out{database="primary"} 1.0', lines)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_reads_from_replica(self):
+        """
+        Tests whether GET requests read from a replica until they or the client write
+        :return:
+        """
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.app.config['SQLALCHEMY_REPLICA_URIS'] = ['sqlite:///{}'.format(path)]
+        with self.app.app_context():
+            replica, = db.get_replica_engines()
+            db.metadata.create_all(replica)
+            db.session.add(Book(**self.book))
+            db.session.commit()
+
+        try:
+            with self.app.test_request_context('/api/v2/books'):
+                self.assertEqual(Book.query.count(), 0)
+                db.session.add(Book(**dict(self.book, title='The River Between')))
+                db.session.flush()
+                self.assertEqual(Book.query.count(), 2)
+                db.session.rollback()
+
+            with self.app.test_request_context('/api/v2/books', method='POST'):
+                self.assertEqual(Book.query.count(), 1)
+
+            # A client that wrote reads from the primary in its next requests too
+            self.app.extensions['response_cache'] = None
+            admin_access_token = AdminTestCase.register_login_admin(self)
+            self.client.post('/api/v2/books', data=json.dumps(dict(self.book, title='Petals of Blood')),
+                             headers={'content-type': 'application/json',
+                                      'Authorization': 'Bearer {}'.format(admin_access_token)})
+            response = self.client.get('/api/v2/books', content_type="application/json")
+            self.assertIn('Petals of Blood', str(response.data))
+
+            response = self.app.test_client().get('/api/v2/books', content_type="application/json")
+            self.assertNotIn('Petals of Blood', str(response.data))
+        finally:
+            replica.dispose()
+            os.remove(path)
+
+    def test_revocations_read_from_primary(self):
+        """
+        Tests that the revocation cache refreshes from the primary while GET reads use a replica
+        :return:
+        """
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.app.config['SQLALCHEMY_REPLICA_URIS'] = ['sqlite:///{}'.format(path)]
+        with self.app.app_context():
+            replica, = db.get_replica_engines()
+            db.metadata.create_all(replica)
+            RevokedTokens(jti='revoked-on-primary').revoke_token()
+
+        try:
+            with self.app.test_request_context('/api/v2/books'):
+                self.assertTrue(revocation_cache.is_revoked('revoked-on-primary'))
+                self.assertEqual(RevokedTokens.query.count(), 0)
+        finally:
+            replica.dispose()
+            os.remove(path)
+
     def test_borrowing_history(self):
         access_token = UserTestCase.register_login_user(self)
 
@@ -1,7 +1,16 @@
+import os
+import tempfile
 import unittest
 import json
+from datetime import datetime, timedelta
+from unittest import mock
 
-from api import create_app, db
+from api import create_app, db, password_hasher, rate_limiter
+from api.decorators import rate_limited
+from api.jobs import work
+from api.models import Job, RevokedTokens, User
+from api.ratelimit import MemoryStore, SQLiteStore, parse_limit
+from config import TestingConfig
 
 
 class UserTestCase(unittest.TestCase):
@@ -65,6 +74,18 @@ class UserTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("This Email already exists.", str(response.data))
 
+    def test_user_registration_duplicate_email(self):
+        """
+        Tests that an email cannot be registered twice
+        :return:
+        """
+        self.client.post('/api/v2/auth/register', data=json.dumps(self.user), content_type='application/json')
+        user = dict(self.user, username='brian2')
+        response = self.client.post('/api/v2/auth/register', data=json.dumps(user), content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("This Email already exists.", str(response.data))
+
     def test_register_user_without_email(self):
         """
         Tests whether the register user registration API endpoint can pass without email
@@ -191,6 +212,25 @@ class UserTestCase(unittest.TestCase):
 
         self.assertEqual(response.status_code, 400)
 
+    def test_logged_out_token_is_revoked(self):
+        """
+        Tests that a token cannot be used after logging out
+        :return:
+        """
+        access_token = self.register_login_user()
+        headers = {'content-type': 'application/json',
+                   'Authorization': 'Bearer {}'.format(access_token)}
+
+        response = self.client.get('/api/v2/users/books', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post('/api/v2/auth/logout', data=json.dumps({'email': self.user['email']}),
+                                    headers=headers)
+        self.assertIn("User successfully logged out.", str(response.data))
+
+        response = self.client.get('/api/v2/users/books', headers=headers)
+        self.assertEqual(response.status_code, 401)
+
     def test_user_reset_password(self):
         access_token = self.register_login_user()
 
@@ -201,6 +241,170 @@ class UserTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("Password reset successful.", str(response.data))
 
+    def test_reset_password_with_cached_user(self):
+        """
+        Tests that a user served from the identity cache can still be updated
+        :return:
+        """
+        access_token = self.register_login_user()
+        headers = {'content-type': 'application/json',
+                   'Authorization': 'Bearer {}'.format(access_token)}
+
+        # Loads the user into the identity cache
+        response = self.client.get('/api/v2/users/books', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        user = {"email": "brain@gmail.com", "password": "yutuuruty891!"}
+        response = self.client.post('/api/v2/auth/reset', data=json.dumps(user), headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post('/api/v2/auth/login', data=json.dumps(user),
+                                    headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_password_rehashed_on_login(self):
+        """
+        Tests that a login upgrades a hash made with an older cost
+        :return:
+        """
+        self.register_login_user()
+
+        self.app.config['PASSWORD_HASH_ITERATIONS'] = 2000
+        self.app.config['PASSWORD_HASH_WORKERS'] = 2
+        password_hasher.init_app(self.app)
+        response = self.client.post('/api/v2/auth/login', data=json.dumps(self.user),
+                                    headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+
+        with self.app.app_context():
+            hashed = User.get_user_by_email(self.user['email']).user_password
+        self.assertTrue(hashed.startswith('pbkdf2:sha256:2000$'))
+
+        wrong = dict(self.user, password='r7eeeeooN')
+        response = self.client.post('/api/v2/auth/login', data=json.dumps(wrong),
+                                    headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_login_rate_limited(self):
+        """
+        Tests that repeated logins for one email are rejected before the password is checked
+        :return:
+        """
+        self.client.post('/api/v2/auth/register', data=json.dumps(self.user), content_type='application/json')
+        wrong = dict(self.user, password='r7eeeeooN')
+        for _ in range(5):
+            response = self.client.post('/api/v2/auth/login', data=json.dumps(wrong),
+                                        headers={'content-type': 'application/json'})
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.post('/api/v2/auth/login', data=json.dumps(self.user),
+                                    headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+
+    @staticmethod
+    def limited_client(limits, trusted_proxies=0):
+        """
+        Client of an app with a /limited endpoint that only checks its rate limits
+        :param limits:
+        :param trusted_proxies:
+        :return:
+        """
+        with mock.patch.object(TestingConfig, 'TRUSTED_PROXIES', trusted_proxies):
+            app = create_app(config_name='testing')
+        app.config.update(RATE_LIMITS={'limited': limits}, RATE_LIMIT_STORAGE='memory')
+        rate_limiter.init_app(app)
+        app.add_url_rule('/limited', 'limited', rate_limited(lambda: {'message': 'ok'}), methods=['POST'])
+        return app.test_client()
+
+    def test_rate_limit_behind_proxy(self):
+        """
+        Tests that the client address is taken from X-Forwarded-For only behind trusted proxies
+        :return:
+        """
+        def post(client, address):
+            return client.post('/limited', headers={'X-Forwarded-For': address}).status_code
+
+        # Without trusted proxies the header is ignored, it could be forged
+        client = self.limited_client({'ip': '2/minute'})
+        self.assertEqual([post(client, '10.0.0.{}'.format(number)) for number in range(3)], [200, 200, 429])
+
+        client = self.limited_client({'ip': '2/minute'}, trusted_proxies=1)
+        self.assertEqual([post(client, '10.0.1.1') for _ in range(3)], [200, 200, 429])
+        self.assertEqual(post(client, '10.0.1.2'), 200)
+
+    def test_rate_limit_takes_all_buckets_or_none(self):
+        """
+        Tests that a request refused by its ip bucket takes nothing from the email bucket
+        :return:
+        """
+        client = self.limited_client({'ip': '1/minute', 'email': '2/minute'})
+
+        def post(address):
+            return client.post('/limited', data=json.dumps({'email': self.user['email']}),
+                               content_type='application/json',
+                               environ_base={'REMOTE_ADDR': address}).status_code
+
+        self.assertEqual([post('10.0.0.1') for _ in range(4)], [200, 429, 429, 429])
+        self.assertEqual(post('10.0.0.2'), 200)
+
+    def test_login_requires_json(self):
+        """
+        Tests that form encoded logins are refused
+        :return:
+        """
+        self.client.post('/api/v2/auth/register', data=json.dumps(self.user), content_type='application/json')
+        response = self.client.post('/api/v2/auth/login',
+                                    data={'email': self.user['email'], 'password': self.user['password']})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Login credentials must be sent as JSON', str(response.data))
+
+    def test_rate_limit_stores(self):
+        """
+        Tests that the memory and SQLite token buckets refill at the configured rate
+        :return:
+        """
+        capacity, rate = parse_limit('2/minute')
+        with tempfile.TemporaryDirectory() as directory:
+            for store in (MemoryStore(), SQLiteStore(os.path.join(directory, 'buckets.db'))):
+                self.assertEqual(store.consume('key', capacity, rate, now=0), 0)
+                self.assertEqual(store.consume('key', capacity, rate, now=1), 0)
+                self.assertAlmostEqual(store.consume('key', capacity, rate, now=2), 28)
+                self.assertEqual(store.consume('key', capacity, rate, now=30), 0)
+                self.assertEqual(store.consume('other', capacity, rate, now=30), 0)
+
+                # Nothing is taken unless every bucket has a token
+                self.assertAlmostEqual(store.consume_all([('other', capacity, rate), ('key', capacity, rate)],
+                                                         now=30), 30)
+                self.assertEqual(store.consume('other', capacity, rate, now=30), 0)
+
+            # The bucket file must not sit where other users could plant one
+            os.chmod(directory, 0o777)
+            self.assertRaises(RuntimeError, SQLiteStore, os.path.join(directory, 'buckets.db'))
+
+    def test_background_jobs(self):
+        """
+        Tests that logging out leaves the token cleanup to the worker's periodic
+        jobs and that they prune expired revocations
+        :return:
+        """
+        access_token = self.register_login_user()
+        response = self.client.post('/api/v2/auth/logout', data=json.dumps({'email': self.user['email']}),
+                                    headers={'content-type': 'application/json',
+                                             'Authorization': 'Bearer {}'.format(access_token)})
+        self.assertIn('User successfully logged out.', str(response.data))
+
+        with self.app.app_context():
+            old = RevokedTokens(jti='expired-token')
+            old.time_revoked = datetime.now() - timedelta(days=1)
+            old.revoke_token()
+            self.assertEqual(Job.query.count(), 0)
+
+            self.assertEqual(work(once=True), len(self.app.config['PERIODIC_JOBS']))
+            self.assertEqual(Job.query.filter(Job.status != 'done').count(), 0)
+            self.assertEqual(RevokedTokens.query.count(), 1)
+            self.assertEqual(work(once=True), 0)
+
     def tearDown(self):
         """
         Drop all tables after tests are complete.